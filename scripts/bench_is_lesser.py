@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Micro benchmark comparing fedoidc.is_lesser with the implementation it
+replaced, the one that compares every pair of list items.
+"""
+import timeit
+
+from fedoidc import is_lesser
+
+
+def is_lesser_pairwise(a, b):
+    """
+    The previous implementation of fedoidc.is_lesser
+    """
+    if type(a) != type(b):
+        return False
+
+    if isinstance(a, str) and isinstance(b, str):
+        return a == b
+    elif isinstance(a, bool) and isinstance(b, bool):
+        return a == b
+    elif isinstance(a, list) and isinstance(b, list):
+        for element in a:
+            flag = 0
+            for e in b:
+                if is_lesser_pairwise(element, e):
+                    flag = 1
+                    break
+            if not flag:
+                return False
+        return True
+    elif isinstance(a, dict) and isinstance(b, dict):
+        if is_lesser_pairwise(list(a.keys()), list(b.keys())):
+            for key, val in a.items():
+                if not is_lesser_pairwise(val, b[key]):
+                    return False
+            return True
+        return False
+    elif isinstance(a, int) and isinstance(b, int):
+        return a <= b
+    elif isinstance(a, float) and isinstance(b, float):
+        return a <= b
+
+    return False
+
+
+def _uris(num):
+    return ['https://rp{}.example.com/authz_cb'.format(n) for n in range(num)]
+
+
+CASES = [
+    ('scope', ['openid', 'email'], ['openid', 'email', 'phone', 'address']),
+    ('redirect_uris 10', _uris(10), _uris(20)),
+    ('redirect_uris 300', _uris(300), list(reversed(_uris(600)))),
+    ('contacts 100', ['{}@example.com'.format(n) for n in range(100)],
+     ['{}@example.com'.format(n) for n in range(200)]),
+    ('dict', dict([(str(n), _uris(10)) for n in range(50)]),
+     dict([(str(n), _uris(20)) for n in range(100)])),
+]
+
+
+def main(number=100):
+    print('{:20} {:>12} {:>12} {:>8}'.format('case', 'pairwise', 'is_lesser',
+                                             'speedup'))
+    for name, a, b in CASES:
+        assert is_lesser(a, b) == is_lesser_pairwise(a, b)
+        _old = timeit.timeit(lambda: is_lesser_pairwise(a, b), number=number)
+        _new = timeit.timeit(lambda: is_lesser(a, b), number=number)
+        print('{:20} {:>10.2f}ms {:>10.2f}ms {:>7.1f}x'.format(
+            name, 1000 * _old / number, 1000 * _new / number, _old / _new))
+
+
+if __name__ == '__main__':
+    main()
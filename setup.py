@@ -42,6 +42,10 @@ if sys.version_info[0] == 2 and sys.version_info[1] == 6:
 else:
     extra_install_requires = []
 
+# concurrent.futures is only part of the standard library in Python 3
+if sys.version_info[0] == 2:
+    extra_install_requires.append("futures")
+
 version = ''
 with open('src/fedoidc/__init__.py', 'r') as fd:
     version = re.search(r'^__version__\s*=\s*[\'"]([^\'"]*)[\'"]',
@@ -72,7 +76,7 @@ setup(
          "six",
          'oic >= 0.11.0.1',
          "Cherrypy",
-         'cherrypy-cors >= 1.5'],
+         'cherrypy-cors >= 1.5'] + extra_install_requires,
     zip_safe=False,
     cmdclass={'test': PyTest},
     scripts=['example/fed_oprp_setup.py', 'scripts/create_jwks.py',
@@ -1,14 +1,23 @@
 import json
 import logging
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:  # Python 2
+    from collections import MutableMapping
+
+from jwkest import BadSignature
+from jwkest import as_bytes
 from jwkest import as_unicode
+from jwkest import b64d
+from jwkest.jws import JWSException
+from jwkest.jws import SIGNER_ALGS
+from jwkest.jws import alg2keytype
 from jwkest.jws import factory
 from oic.utils import keyio
 from six import PY2
 from six import string_types
 
-from oic.utils.keyio import KeyJar
-
 from oic.oauth2.message import SINGLE_OPTIONAL_STRING
 from oic.oauth2.exception import VerificationError
 from oic.oauth2.message import OPTIONAL_LIST_OF_STRINGS
@@ -105,16 +114,78 @@ class ProviderConfigurationResponse(message.ProviderConfigurationResponse):
     c_param.update(message.ProviderConfigurationResponse.c_param.copy())
 
 
+class ParsedJWS(object):
+    """
+    A signed JWT in compact serialization that has been split, base64 decoded
+    and JSON parsed. This is done once and the result is then used
+    for everything that has to be done with the JWT.
+    The signature is NOT verified by creating an instance of this class.
+    """
+
+    def __init__(self, jws):
+        """
+        :param jws: A signed JWT
+        """
+        self.jws = as_unicode(jws)
+        _part = self.jws.split('.')
+        if len(_part) != 3:
+            raise JWSException('Not a compact JWS')
+
+        try:
+            self.header = json.loads(as_unicode(b64d(as_bytes(_part[0]))))
+            self.payload = json.loads(as_unicode(b64d(as_bytes(_part[1]))))
+            self.signature = b64d(as_bytes(_part[2]))
+        except (ValueError, TypeError) as err:
+            raise JWSException('Could not parse JWS: {}'.format(err))
+
+        if not isinstance(self.header, dict) or 'alg' not in self.header:
+            raise JWSException('Not a JWS')
+        if not isinstance(self.payload, dict):
+            raise JWSException('Payload not a JSON object')
+
+        self.signing_input = as_bytes('.'.join(_part[:2]))
+
+    @property
+    def kid(self):
+        return self.header.get('kid', '')
+
+    @property
+    def alg(self):
+        return self.header['alg']
+
+    def verify(self, keys):
+        """
+        Verify the signature using one of the given keys.
+
+        :param keys: List of keys, should be the ones that match kid and alg
+        :return: The key that was used to verify the signature
+        """
+        try:
+            _verifier = SIGNER_ALGS[self.alg]
+        except KeyError:
+            raise JWSException('Unknown algorithm: {}'.format(self.alg))
+
+        for key in keys:
+            try:
+                if _verifier.verify(self.signing_input, self.signature,
+                                    key.get_key(alg=self.alg, private=False)):
+                    return key
+            except (BadSignature, IndexError):
+                pass
+
+        raise BadSignature()
+
+
 def unfurl(jwt):
     """
     Return the body of a signed JWT, without verifying the signature.
     
-    :param jwt: A signed JWT 
-    :return: The body of the JWT as a 'UTF-8' string
+    :param jwt: A signed JWT or a :py:class:`ParsedJWS` instance
+    :return: The body of the JWT as a dictionary
     """
-
-    _rp_jwt = factory(jwt)
-    return json.loads(_rp_jwt.jwt.part[1].decode('utf8'))
+    if isinstance(jwt, ParsedJWS):
+        return jwt.payload
+    return ParsedJWS(jwt).payload
 
 
 def keyjar_from_metadata_statements(iss, msl):
@@ -146,6 +217,89 @@ def read_jwks_file(jwks_file):
     return _kj
 
 
+def _list_comparator(typ, candidates):
+    """
+    Build a function that checks whether an item of a specific type is less
+    or equal to one of a number of candidates of the same type.
+
+    :param typ: The type of the items
+    :param candidates: The items in the superior list that has that type
+    :return: A function that takes one item and returns True or False
+    """
+    if not candidates:
+        return lambda x: False
+
+    if issubclass(typ, string_types) or issubclass(typ, bool):
+        return set(candidates).__contains__
+    elif issubclass(typ, (int, float)):
+        _max = max(candidates)
+        return lambda x: x <= _max
+    elif issubclass(typ, (list, dict)):
+        return lambda x: any([is_lesser(x, c) for c in candidates])
+
+    return lambda x: False
+
+
+def _lesser_list_comparator(b):
+    """
+    Build a function that checks that every item in a list is less or equal
+    to some item in b.
+    """
+    _by_type = {}
+    for item in b:
+        try:
+            _by_type[type(item)].append(item)
+        except KeyError:
+            _by_type[type(item)] = [item]
+
+    _comparator = {}
+
+    def _cmp(a):
+        for item in a:
+            _type = type(item)
+            try:
+                _c = _comparator[_type]
+            except KeyError:
+                _c = _list_comparator(_type, _by_type.get(_type))
+                _comparator[_type] = _c
+            if not _c(item):
+                return False
+        return True
+
+    return _cmp
+
+
+def _is_lesser_list(a, b):
+    """
+    Every item in a must be less or equal to some item in b.
+    """
+    return _lesser_list_comparator(b)(a)
+
+
+def lesser_comparator(b):
+    """
+    Build a function that given a value a returns is_lesser(a, b). What
+    only depends on b is done once, which makes the function cheap to apply
+    over and over again.
+
+    :param b: The superior value
+    :return: A function that takes one value and returns True or False
+    """
+    if PY2:
+        return lambda a: is_lesser(a, b)
+
+    _type = type(b)
+    if isinstance(b, string_types) or isinstance(b, bool):
+        return lambda a: type(a) is _type and a == b
+    elif isinstance(b, list):
+        _cmp = _lesser_list_comparator(b)
+        return lambda a: type(a) is _type and _cmp(a)
+    elif isinstance(b, (int, float)):
+        return lambda a: type(a) is _type and a <= b
+
+    return lambda a: is_lesser(a, b)
+
+
 def is_lesser(a, b):
     """
     Verify that a is <= then b
@@ -166,22 +320,26 @@ def is_lesser(a, b):
     elif isinstance(a, bool) and isinstance(b, bool):
         return a == b
     elif isinstance(a, list) and isinstance(b, list):
-        for element in a:
-            flag = 0
-            for e in b:
-                if is_lesser(element, e):
-                    flag = 1
-                    break
-            if not flag:
-                return False
-        return True
-    elif isinstance(a, dict) and isinstance(b, dict):
-        if is_lesser(list(a.keys()), list(b.keys())):
-            for key, val in a.items():
-                if not is_lesser(val, b[key]):
+        # For short lists comparing item by item is cheaper. In Python 2
+        # str and unicode items must be comparable.
+        if PY2 or len(a) * len(b) <= 16:
+            for x in a:
+                for y in b:
+                    if is_lesser(x, y):
+                        break
+                else:
                     return False
             return True
-        return False
+        return _is_lesser_list(a, b)
+    elif isinstance(a, dict) and isinstance(b, dict):
+        for key, val in a.items():
+            try:
+                _val = b[key]
+            except KeyError:
+                return False
+            if not is_lesser(val, _val):
+                return False
+        return True
     elif isinstance(a, int) and isinstance(b, int):
         return a <= b
     elif isinstance(a, float) and isinstance(b, float):
@@ -212,7 +370,7 @@ class KeyBundle(keyio.KeyBundle):
                                         fileformat=fileformat,
                                         keytype=keytype, keyusage=keyusage)
         if verify_keys is not None:
-            if isinstance(verify_keys, KeyJar):
+            if isinstance(verify_keys, keyio.KeyJar):
                 self.verify_keys = verify_keys
             else:
                 self.verify_keys = KeyJar()
@@ -239,8 +397,10 @@ class KeyBundle(keyio.KeyBundle):
                 logger.debug(
                     "Signed JWKS: %s from %s" % (response.text, self.source))
                 _jws = factory(response.text)
-                _resp = _jws.verify_compact(
-                    response.text, keys=self.verify_keys.get_signing_key())
+                _keys = verification_keys(self.verify_keys, '',
+                                          _jws.jwt.headers.get('kid', ''),
+                                          _jws.jwt.headers.get('alg', ''))
+                _resp = _jws.verify_compact(response.text, keys=_keys)
                 return _resp
             else:
                 logger.error('Wrong content type: {}'.format(
@@ -248,3 +408,307 @@ class KeyBundle(keyio.KeyBundle):
                 return None
         except KeyError:
             pass
+
+
+#: Which elliptic curve that goes with which signing algorithm
+EC_CURVE = {'ES256': 'P-256', 'ES384': 'P-384', 'ES512': 'P-521'}
+
+
+def usable_keys(kbl, kid='', alg=''):
+    """
+    Pick the keys in a list of key bundles that could have been used to sign
+    a JWS.
+
+    :param kbl: List of :py:class:`oic.utils.keyio.KeyBundle` instances
+    :param kid: Key ID from the JWS header
+    :param alg: Signing algorithm from the JWS header
+    :return: List of keys
+    """
+    if alg:
+        _kty = alg2keytype(alg)
+        if _kty is None or _kty == 'none':
+            return []
+        _kty = _kty.lower()
+    else:
+        _kty = ''
+
+    res = []
+    for kb in kbl:
+        for key in kb.keys():
+            if key.use and key.use != 'sig':
+                continue
+            if _kty:
+                if key.kty.lower() != _kty:
+                    continue
+                if _kty == 'ec' and alg in EC_CURVE:
+                    if key.crv != EC_CURVE[alg]:
+                        continue
+            if kid:
+                if key.kid == kid:
+                    return [key]
+            else:
+                res.append(key)
+    return res
+
+
+def _issuer_variants(owner):
+    if owner.endswith('/'):
+        return [owner, owner[:-1]]
+    elif owner:
+        return [owner, owner + '/']
+    else:
+        return [owner]
+
+
+class KeyJar(keyio.KeyJar):
+    """
+    A KeyJar that keeps an index over the keys that can be used to verify
+    signatures. The index maps (owner, kid, alg) to keys. The part of the
+    index that belongs to an owner is dropped as soon as the keys belonging
+    to that owner changes.
+    """
+
+    def __init__(self, *args, **kwargs):
+        # The arguments differs between versions of pyoidc
+        super(KeyJar, self).__init__(*args, **kwargs)
+        self.index = {}
+
+    def forget(self, owner=None):
+        """
+        Remove index entries.
+
+        :param owner: Remove only the entries for this owner. If None the
+            whole index is dropped.
+        """
+        if owner is None:
+            self.index = {}
+            return
+
+        for _owner in _issuer_variants(owner):
+            try:
+                del self.index[_owner]
+            except KeyError:
+                pass
+
+    def _key_bundles(self, owner):
+        for _owner in _issuer_variants(owner):
+            try:
+                return self.issuer_keys[_owner]
+            except KeyError:
+                pass
+        return []
+
+    def verification_keys(self, owner, kid='', alg=''):
+        """
+        Find the keys that could be used to verify a signature.
+
+        :param owner: The owner of the keys, normally the issuer of the JWS
+        :param kid: Key ID from the JWS header
+        :param alg: Signing algorithm from the JWS header
+        :return: List of keys, only one if a kid was given
+        """
+        try:
+            return self.index[owner][(kid, alg)]
+        except KeyError:
+            pass
+
+        _kbl = self._key_bundles(owner)
+        _keys = usable_keys(_kbl, kid, alg)
+
+        # Remote key bundles may change behind my back
+        for kb in _kbl:
+            if kb.remote:
+                return _keys
+
+        try:
+            self.index[owner][(kid, alg)] = _keys
+        except KeyError:
+            self.index[owner] = {(kid, alg): _keys}
+        return _keys
+
+    def add(self, issuer, url, **kwargs):
+        self.forget(issuer)
+        return super(KeyJar, self).add(issuer, url, **kwargs)
+
+    def add_symmetric(self, issuer, key, usage=None):
+        self.forget(issuer)
+        super(KeyJar, self).add_symmetric(issuer, key, usage=usage)
+
+    def add_kb(self, issuer, kb):
+        self.forget(issuer)
+        super(KeyJar, self).add_kb(issuer, kb)
+
+    def __setitem__(self, issuer, val):
+        self.forget(issuer)
+        super(KeyJar, self).__setitem__(issuer, val)
+
+    def import_jwks(self, jwks, issuer):
+        self.forget(issuer)
+        super(KeyJar, self).import_jwks(jwks, issuer)
+
+    def add_keyjar(self, keyjar):
+        for iss in keyjar.keys():
+            self.forget(iss)
+        super(KeyJar, self).add_keyjar(keyjar)
+
+    def update(self, kj):
+        for iss in kj.keys():
+            self.forget(iss)
+        super(KeyJar, self).update(kj)
+
+    def restore(self, info):
+        for iss in info.keys():
+            self.forget(iss)
+        super(KeyJar, self).restore(info)
+
+    def load_keys(self, pcr, issuer, replace=False):
+        self.forget(issuer)
+        super(KeyJar, self).load_keys(pcr, issuer, replace=replace)
+
+    def remove_key(self, issuer, key_type, key):
+        self.forget(issuer)
+        super(KeyJar, self).remove_key(issuer, key_type, key)
+
+    def remove_outdated(self):
+        self.forget()
+        super(KeyJar, self).remove_outdated()
+
+    def copy(self):
+        kj = KeyJar(verify_ssl=self.verify_ssl)
+        kj.issuer_keys = super(KeyJar, self).copy().issuer_keys
+        return kj
+
+    def overlay(self):
+        """
+        Make a KeyJar where keys can be added and removed without affecting
+        this instance.
+
+        :return: A :py:class:`fedoidc.KeyJarOverlay` instance
+        """
+        return KeyJarOverlay(self)
+
+
+class _Overlay(MutableMapping):
+    """
+    A dictionary on top of another dictionary. Reads fall through to the
+    underlying dictionary, writes and deletes only affect the overlay.
+    """
+
+    def __init__(self, base, copy_value=None):
+        """
+        :param base: The underlying dictionary, never modified
+        :param copy_value: If given, a function that is used to make a
+            private copy of a value read from the underlying dictionary.
+            Needed if the values are modified in place.
+        """
+        self.base = base
+        self.local = {}
+        self.hidden = set()
+        self.copy_value = copy_value
+
+    def __getitem__(self, key):
+        try:
+            return self.local[key]
+        except KeyError:
+            if key in self.hidden:
+                raise
+
+        val = self.base[key]
+        if self.copy_value is not None:
+            val = self.copy_value(val)
+            self.local[key] = val
+        return val
+
+    def __setitem__(self, key, value):
+        self.local[key] = value
+        self.hidden.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.local.pop(key, None)
+        self.hidden.add(key)
+
+    def __contains__(self, key):
+        if key in self.local:
+            return True
+        return key not in self.hidden and key in self.base
+
+    def __iter__(self):
+        for key in self.local:
+            yield key
+        for key in self.base:
+            if key not in self.local and key not in self.hidden:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class KeyJarOverlay(KeyJar):
+    """
+    A KeyJar on top of another KeyJar. Keys are looked up in the
+    underlying KeyJar unless they have been added to or removed from the
+    overlay. Changes never reach the underlying KeyJar, so an overlay can be
+    thrown away when it is no longer needed. Creating one is cheap, the
+    underlying KeyJar is not copied.
+
+    The key bundles of the underlying KeyJar are shared and must not be
+    modified through the overlay.
+    """
+
+    def __init__(self, base):
+        """
+        :param base: A :py:class:`oic.utils.keyio.KeyJar` instance
+        """
+        super(KeyJarOverlay, self).__init__(
+            verify_ssl=base.verify_ssl, keybundle_cls=base.keybundle_cls,
+            remove_after=base.remove_after)
+        self.base = base
+        # Lists of key bundles are copied on first use since they are
+        # extended in place when keys are added.
+        self.issuer_keys = _Overlay(base.issuer_keys, list)
+        # Owners whose keys have been changed in the overlay. Only those
+        # have entries in the index of the overlay, lookups for all other
+        # owners use (and fill in) the index of the underlying KeyJar.
+        self.changed = set()
+
+    def forget(self, owner=None):
+        if owner is None:
+            self.changed.update(self.issuer_keys)
+        else:
+            self.changed.update(_issuer_variants(owner))
+        super(KeyJarOverlay, self).forget(owner)
+
+    def _changed(self, owner):
+        for _owner in _issuer_variants(owner):
+            if _owner in self.changed or _owner in self.issuer_keys.hidden:
+                return True
+        return False
+
+    def verification_keys(self, owner, kid='', alg=''):
+        if isinstance(self.base, KeyJar) and not self._changed(owner):
+            return self.base.verification_keys(owner, kid, alg)
+        return super(KeyJarOverlay, self).verification_keys(owner, kid, alg)
+
+
+def verification_keys(keyjar, owner, kid='', alg=''):
+    """
+    Find the keys in a KeyJar that could be used to verify a signature.
+    Uses the index if the KeyJar has one.
+
+    :param keyjar: A :py:class:`oic.utils.keyio.KeyJar` instance
+    :param owner: The owner of the keys
+    :param kid: Key ID from the JWS header
+    :param alg: Signing algorithm from the JWS header
+    :return: List of keys
+    """
+    if isinstance(keyjar, KeyJar):
+        return keyjar.verification_keys(owner, kid, alg)
+
+    for _owner in _issuer_variants(owner):
+        try:
+            return usable_keys(keyjar.issuer_keys[_owner], kid, alg)
+        except KeyError:
+            pass
+    return []
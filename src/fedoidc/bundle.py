@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 import json
 import os
+import time
 
+from fedoidc import KeyJar
 from fedoidc.file_system import FileSystem
 
+from oic.utils import keyio
 from oic.utils.jwt import JWT
-from oic.utils.keyio import KeyJar
 from oic.utils.keyio import build_keyjar
 
 
@@ -27,6 +29,10 @@ class JWKSBundle(object):
         self.iss = iss
         self.sign_keys = sign_keys
         self.bundle = {}  # In memory database
+        # Changes every time the content of the bundle changes
+        self.generation = 0
+        self._keyjar = None
+        self._keyjar_generation = None
 
     def __setitem__(self, key, value):
         """
@@ -37,7 +43,7 @@ class JWKSBundle(object):
          issuer ID.
         :type value: KeyJar or a JWKS (JSON document)
         """
-        if not isinstance(value, KeyJar):
+        if not isinstance(value, keyio.KeyJar):
             kj = KeyJar()
             kj.import_jwks(value, issuer=key)
             value = kj
@@ -57,6 +63,7 @@ class JWKSBundle(object):
             value = _val
 
         self.bundle[key] = value
+        self.generation += 1
 
     def __getitem__(self, item):
         """
@@ -80,6 +87,7 @@ class JWKSBundle(object):
         :param key: Issuer ID
         """
         del self.bundle[key]
+        self.generation += 1
 
     def create_signed_bundle(self, sign_alg='RS256', iss_list=None):
         """
@@ -111,6 +119,7 @@ class JWKSBundle(object):
             kj = KeyJar()
             kj.import_jwks(jwks, issuer=iss)
             self.bundle[iss] = kj
+        self.generation += 1
         return self
 
     def dumps(self, iss_list=None):
@@ -169,19 +178,33 @@ class JWKSBundle(object):
         jwt = verify_signed_bundle(sign_bundle, ver_keys)
         self.loads(jwt['bundle'])
 
+    def current_generation(self):
+        """
+        Something that changes every time the content of the bundle changes.
+        """
+        return self.generation
+
     def as_keyjar(self):
         """
         Convert a key bundle into a KeyJar instance.
+        The merged KeyJar is only rebuilt when the bundle has changed.
+        The caller gets its own KeyJar so it can add keys to it without
+        affecting the bundle.
         
-        :return: An :py:class:`oic.utils.keyio.KeyJar` instance 
+        :return: A :py:class:`fedoidc.KeyJarOverlay` instance 
         """
-        kj = KeyJar()
-        for iss, k in self.bundle.items():
-            try:
-                kj.issuer_keys[iss] = k.issuer_keys[iss]
-            except KeyError:
-                kj.issuer_keys[iss] = k.issuer_keys['']
-        return kj
+        _gen = self.current_generation()
+        if self._keyjar is None or _gen != self._keyjar_generation:
+            _kj = KeyJar()
+            for iss, k in self.bundle.items():
+                try:
+                    _kj.issuer_keys[iss] = k.issuer_keys[iss]
+                except KeyError:
+                    _kj.issuer_keys[iss] = k.issuer_keys['']
+            self._keyjar = _kj
+            self._keyjar_generation = _gen
+
+        return self._keyjar.overlay()
 
 
 def verify_signed_bundle(signed_bundle, ver_keys):
@@ -291,7 +314,8 @@ class FSJWKSBundle(JWKSBundle):
     A JWKSBundle that keeps the key information in a 
     :py:class:`fedoidc.file_system.FileSystem` instance.
     """
-    def __init__(self, iss, sign_keys=None, fdir='./', key_conv=None):
+    def __init__(self, iss, sign_keys=None, fdir='./', key_conv=None,
+                 sync_interval=1):
         """
 
         :param iss: Issuer ID for this entity
@@ -300,11 +324,27 @@ class FSJWKSBundle(JWKSBundle):
         :param key_conv: Specification of directory key to file name conversion.
             A set of keys are represented in the local cache as a KeyJar 
             instance and as a JWKS on disc.
+        :param sync_interval: How often, in seconds, the directory should be
+            checked for changes made by someone else.
         """
         JWKSBundle.__init__(self, iss, sign_keys=sign_keys)
         self.bundle = FileSystem(fdir, key_conv=key_conv,
                                  value_conv={'to': keyjar_to_jwks,
                                              'from': jwks_to_keyjar})
+        self.sync_interval = sync_interval
+        self._synced = 0
+
+    def current_generation(self):
+        """
+        Besides the changes made through this instance also picks up changes
+        made directly on disc. The directory is checked at most once every
+        *sync_interval* seconds.
+        """
+        _now = time.time()
+        if _now - self._synced >= self.sync_interval:
+            self.bundle.sync()
+            self._synced = _now
+        return self.generation, self.bundle.generation
 
     def clear(self):
         self.bundle.clear()
\ No newline at end of file
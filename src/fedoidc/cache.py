@@ -0,0 +1,290 @@
+import logging
+import threading
+from collections import OrderedDict
+
+from jwkest.jws import JWSException
+from oic.utils.time_util import utc_time_sans_frac
+from six import integer_types
+
+from fedoidc import unfurl
+
+__author__ = 'roland'
+
+logger = logging.getLogger(__name__)
+
+
+class ExpiringCache(object):
+    """
+    A bounded in memory cache where every entry carries its own expiration
+    time. Has a dictionary like interface. When the cache is full the least
+    recently used entry is evicted.
+    The cache can also be bounded by the total size of the entries, in
+    which case the size of each entry has to be given when it is set.
+    """
+
+    def __init__(self, max_entries=1000, max_size=0):
+        """
+        :param max_entries: Maximum number of entries kept in the cache.
+        :param max_size: Maximum total size of the entries kept in the
+            cache. 0 means no limit.
+        """
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.db = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def _remove(self, key):
+        del self.db[key]
+        self.size -= self.sizes.pop(key, 0)
+
+    def set(self, key, value, exp, size=0):
+        """
+        Bind a value to a key.
+
+        :param key: Identifier, must be hashable
+        :param value: The value to store
+        :param exp: Point in time (seconds since epoch) when the entry
+            should be removed.
+        :param size: The size of the entry, only used if the cache is
+            bounded by size.
+        """
+        if self.max_entries <= 0 or exp <= utc_time_sans_frac():
+            return
+        if self.max_size and size > self.max_size:
+            return
+
+        with self.lock:
+            try:
+                self._remove(key)
+            except KeyError:
+                pass
+
+            while len(self.db) >= self.max_entries or (
+                    self.max_size and self.size + size > self.max_size):
+                self._remove(next(iter(self.db)))
+
+            self.db[key] = (exp, value)
+            if size:
+                self.sizes[key] = size
+                self.size += size
+
+    def __getitem__(self, key):
+        with self.lock:
+            exp, value = self.db[key]
+            if exp <= utc_time_sans_frac():
+                logger.debug('Cache entry expired')
+                self._remove(key)
+                raise KeyError(key)
+
+            # Most recently used last, OrderedDict.move_to_end is not
+            # available in Python 2
+            self.db[key] = self.db.pop(key)
+            return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def expires_at(self, key):
+        """
+        When a specific entry will expire.
+
+        :param key: Identifier
+        :return: Seconds since epoch
+        """
+        return self.db[key][0]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def __len__(self):
+        return len(self.db)
+
+    def remove_expired(self):
+        """
+        Remove all entries that has expired.
+        """
+        _now = utc_time_sans_frac()
+        with self.lock:
+            for key in [k for k, (exp, _) in self.db.items() if exp <= _now]:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.db.clear()
+            self.sizes.clear()
+            self.size = 0
+
+
+def _header(headers, name):
+    """
+    Case insensitive lookup of a HTTP header.
+    """
+    if not headers:
+        return None
+    try:
+        return headers[name]
+    except KeyError:
+        name = name.lower()
+        for key, val in headers.items():
+            if key.lower() == name:
+                return val
+    return None
+
+
+def cache_control(headers):
+    """
+    Parse the Cache-Control header of a HTTP response.
+
+    :param headers: HTTP response headers
+    :return: dictionary with directive names as keys.
+    """
+    _cc = _header(headers, 'Cache-Control')
+    res = {}
+    if not _cc:
+        return res
+
+    for item in _cc.split(','):
+        item = item.strip().lower()
+        if not item:
+            continue
+        if '=' in item:
+            key, val = item.split('=', 1)
+            res[key.strip()] = val.strip().strip('"')
+        else:
+            res[item] = True
+    return res
+
+
+class CachedResponse(object):
+    """
+    The parts of a HTTP response that are kept in the cache.
+    """
+
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class HTTPCache(object):
+    """
+    A cache for signed metadata statements fetched over HTTP.
+    Follows the Cache-Control, ETag and Last-Modified headers of the response.
+    A statement is never kept beyond its own expiration time. Failures (404
+    and 5xx) are remembered for a short while.
+    """
+
+    def __init__(self, max_entries=1000, negative_ttl=30):
+        """
+        :param max_entries: Max number of URLs to keep responses for.
+        :param negative_ttl: For how many seconds a failed fetch should be
+            remembered.
+        """
+        self.db = ExpiringCache(max_entries)
+        self.negative_ttl = negative_ttl
+
+    @staticmethod
+    def statement_exp(text):
+        try:
+            _exp = unfurl(text)['exp']
+        except (JWSException, ValueError, KeyError, TypeError, IndexError,
+                AttributeError):
+            return 0
+        # Nothing has been verified, the value may be anything
+        if isinstance(_exp, bool) or \
+                not isinstance(_exp, integer_types + (float,)):
+            return 0
+        return _exp
+
+    def _store(self, url, rsp, cached=None):
+        """
+        Store a successful response.
+
+        :param url: The URL the response came from
+        :param rsp: The HTTP response
+        :param cached: The response already in the cache, used on revalidation
+        """
+        _headers = getattr(rsp, 'headers', None)
+        _cc = cache_control(_headers)
+        if 'no-store' in _cc:
+            return
+
+        if cached:
+            _resp = cached
+        else:
+            _resp = CachedResponse(200, rsp.text, {
+                'ETag': _header(_headers, 'ETag'),
+                'Last-Modified': _header(_headers, 'Last-Modified')})
+
+        exp = self.statement_exp(_resp.text)
+        if not exp:  # Not a statement I can trust the lifetime of
+            return
+
+        now = utc_time_sans_frac()
+        if 'no-cache' in _cc:
+            fresh_until = now
+        elif 'max-age' in _cc:
+            try:
+                fresh_until = min(now + int(_cc['max-age']), exp)
+            except ValueError:
+                fresh_until = now
+        else:  # immutable until it expires
+            fresh_until = exp
+
+        self.db.set(url, (fresh_until, _resp), exp)
+
+    def fetch(self, httpcli, url):
+        """
+        Fetch a signed metadata statement, using the cache if possible.
+
+        :param httpcli: HTTP client to use if the statement has to be fetched
+        :param url: Where the signed metadata statement can be found.
+        :return: A HTTP response like object
+        """
+        try:
+            fresh_until, cached = self.db[url]
+        except KeyError:
+            cached = None
+        else:
+            if fresh_until > utc_time_sans_frac():
+                logger.debug('Using cached response from {}'.format(url))
+                return cached
+
+        if cached is not None and cached.status_code == 200:
+            _hdr = {}
+            if cached.headers.get('ETag'):
+                _hdr['If-None-Match'] = cached.headers['ETag']
+            if cached.headers.get('Last-Modified'):
+                _hdr['If-Modified-Since'] = cached.headers['Last-Modified']
+            if _hdr:
+                rsp = httpcli.http_request(url, headers=_hdr)
+            else:
+                rsp = httpcli.http_request(url)
+        else:
+            rsp = httpcli.http_request(url)
+
+        if rsp.status_code == 304 and cached is not None:
+            logger.debug('Cached response from {} still valid'.format(url))
+            self._store(url, rsp, cached)
+            return cached
+        elif rsp.status_code == 200:
+            self._store(url, rsp)
+        elif rsp.status_code == 404 or rsp.status_code >= 500:
+            _now = utc_time_sans_frac()
+            self.db.set(url, (_now + self.negative_ttl,
+                              CachedResponse(rsp.status_code)),
+                        _now + self.negative_ttl)
+        return rsp
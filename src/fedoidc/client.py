@@ -87,7 +87,8 @@ class Client(oic.Client):
         """
 
         les = self.federation_entity.get_metadata_statement(
-            resp, cls=ProviderConfigurationResponse)
+            resp, cls=ProviderConfigurationResponse, lazy=True,
+            priority=self.fo_priority)
 
         if not les:  # No metadata statement that I can use
             raise ParameterError('No trusted metadata')
@@ -99,7 +100,8 @@ class Client(oic.Client):
         if len(les) == 1:
             ms = les[0]
             _claims = ms.protected_claims()
-            self.handle_provider_config(ms.protected_claims(), issuer)
+            # pyoidc keeps, and may modify, what it is given
+            self.handle_provider_config(dict(_claims), issuer)
             if 'signed_jwks_uri' in _claims:
                 _kb = fedoidc.KeyBundle(source=_claims['signed_jwks_uri'],
                                         verify_keys=les.signing_keys,
@@ -127,7 +129,8 @@ class Client(oic.Client):
         :param issuer: Issuer ID
         """
         ms_list = self.federation_entity.get_metadata_statement(
-            resp, cls=ClientMetadataStatement)
+            resp, cls=ClientMetadataStatement, lazy=True,
+            priority=self.fo_priority, first_valid=True)
 
         if not ms_list:  # No metadata statement that I can use
             raise RegistrationError('No trusted metadata')
@@ -141,7 +144,7 @@ class Client(oic.Client):
             _trusted_claims = ms.protected_claims()
             if not _trusted_claims:
                 raise fedoidc.NoTrustedClaims()
-            self.store_registration_info(_trusted_claims)
+            self.store_registration_info(dict(_trusted_claims))
             self.federation = ms.fo
             self.redirect_uris = self.registration_response['redirect_uris']
         else:
@@ -219,8 +222,9 @@ class Client(oic.Client):
         """
         _leo = self.chose_federation(self.provider_federations)
         self.federation = _leo.fo
-        self.handle_provider_config(_leo.protected_claims(), issuer)
-        return ProviderConfigurationResponse(**_leo.protected_claims())
+        _claims = _leo.protected_claims()
+        self.handle_provider_config(dict(_claims), issuer)
+        return ProviderConfigurationResponse(**_claims)
 
     def chose_registration_federation(self):
         """
@@ -232,8 +236,9 @@ class Client(oic.Client):
         """
         _leo = self.chose_federation(self.registration_federations)
         self.federation = _leo.fo
-        self.store_registration_info(_leo.protected_claims)
-        return ClientMetadataStatement(**_leo.protected_claims())
+        _claims = _leo.protected_claims()
+        self.store_registration_info(dict(_claims))
+        return ClientMetadataStatement(**_claims)
 
     def provider_config(self, issuer, keys=True, endpoints=True,
             response_cls=ProviderConfigurationResponse,
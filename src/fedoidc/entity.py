@@ -1,8 +1,17 @@
+import hashlib
+import json
 import logging
 import re
 
+from oic.oauth2.message import Message
+
 from fedoidc import MetadataStatement
+from fedoidc.cache import ExpiringCache
+from fedoidc.operator import Budget
+from fedoidc.operator import LimitExceeded
 from fedoidc.operator import Operator
+from fedoidc.operator import chain_exp
+from fedoidc.operator import chain_size
 
 __author__ = 'roland'
 
@@ -14,7 +23,8 @@ class FederationEntity(Operator):
     An entity in a federation. For instance an OP or an RP.
     """
 
-    def __init__(self, srv, iss='', keyjar=None, signer=None, fo_bundle=None):
+    def __init__(self, srv, iss='', keyjar=None, signer=None, fo_bundle=None,
+                 result_cache_size=1000, result_cache_memory=2 ** 24):
         """
 
         :param srv: A Client or Provider instance
@@ -25,6 +35,11 @@ class FederationEntity(Operator):
             entity produces.
         :param fo_bundle: A bundle of keys that can be used to verify
             the root signature of a compounded metadata statement.
+        :param result_cache_size: Max number of results from
+            :py:meth:`get_metadata_statement` to keep. 0 turns the cache off.
+        :param result_cache_memory: Max total size, in bytes, of the
+            cached results, as estimated by
+            :py:func:`fedoidc.operator.chain_size`.
         """
 
         Operator.__init__(self, iss=iss, keyjar=keyjar, httpcli=srv,
@@ -33,6 +48,8 @@ class FederationEntity(Operator):
         # Who can sign request from this entity
         self.signer = signer
         self.federation = None
+        self.results = ExpiringCache(result_cache_size,
+                                     max_size=result_cache_memory)
 
     @staticmethod
     def pick_by_priority(ms_list, priority=None):
@@ -77,41 +94,154 @@ class FederationEntity(Operator):
                 res.extend((iss, vals))
         return res
 
+    def _unpack_and_evaluate(self, json_ms, cls, context, lazy, skip,
+                             liss=None, budget=None, parsed=None):
+        try:
+            _pi = self.unpack_metadata_statement(json_ms=json_ms, cls=cls,
+                                                 liss=liss, skip=skip,
+                                                 context=context,
+                                                 budget=budget, parsed=parsed)
+        except LimitExceeded as err:
+            logger.error('Gave up unpacking: {}'.format(err))
+            return []
+
+        if not _pi.result:
+            return []
+
+        logger.debug('Managed to unpack the metadata statement')
+
+        try:
+            return self.evaluate_metadata_statement(_pi.result, lazy=lazy)
+        except LimitExceeded as err:
+            logger.error('Gave up evaluating: {}'.format(err))
+            return []
+
+    def _result_key(self, json_ms, *args):
+        """
+        The key under which the result of unpacking and evaluating a
+        metadata statement is cached. Includes the generation of the FO
+        bundle since the result depends on the FO keys.
+
+        :return: The key or None if the metadata statement can not be
+            serialized.
+        """
+        if isinstance(json_ms, Message):
+            _doc = json_ms.to_dict()
+        else:
+            _doc = json_ms
+
+        try:
+            _str = json.dumps(_doc, sort_keys=True, separators=(',', ':'))
+        except (TypeError, ValueError):
+            return None
+
+        if self.jwks_bundle is None:
+            _gen = None
+        else:
+            _gen = self.jwks_bundle.current_generation()
+
+        _digest = hashlib.sha256(_str.encode('utf-8')).hexdigest()
+        return (_digest, _gen) + args
+
     def get_metadata_statement(self, json_ms, cls=MetadataStatement,
-                               context=''):
+                               context='', lazy=False, priority=None,
+                               first_valid=False):
         """
         Unpack and evaluate a compound metadata statement. Goes through the
-        necessary three steps.
-        * unpack the metadata statement
-        * verify that the given statements are expected to be used in this context
+        necessary steps.
+        * without verifying any signatures, find the signed metadata
+          statements that can not be used
+        * unpack the metadata statement, dropping statements that are not
+          expected to be used in this context before verifying them
         * evaluate the metadata statements (= flatten)
+        The result is cached until some part of it expires, so the same
+        metadata statement coming in again is not processed again.
 
         :param json_ms: The metadata statement as a JSON document or a 
             dictionary
         :param cls: The class the response should be typed into
         :param context: In which context the metadata statement should be used.
+        :param lazy: If True claims are evaluated when they are asked for
+            rather then all at once.
+        :param priority: List of FO IDs in order of preference. The result
+            is ordered according to this list.
+        :param first_valid: If True, and a priority list is given, the
+            federations are tried one at the time in priority order. The
+            result from the first one that works is returned and the rest
+            are never looked at. Federations not on the priority list are
+            only tried if none of the ones on the list works.
         :return: A list of :py:class:`fedoidc.operator.LessOrEqual` instances
         """
         logger.debug('Incoming metadata statement: {}'.format(json_ms))
 
-        _pi = self.unpack_metadata_statement(json_ms=json_ms, cls=cls)
-        if not _pi.result:
-            return []
+        if self.results.max_entries > 0:
+            _key = self._result_key(
+                json_ms, cls, context, lazy, tuple(priority or []),
+                first_valid)
+        else:
+            _key = None
 
-        logger.debug('Managed to unpack the metadata statement')
+        if _key is not None:
+            les = self.results.get(_key)
+            if les is not None:
+                logger.debug('Using cached result')
+                return [le.copy() for le in les]
 
-        if context:
-            _cms = self.correct_usage(_pi.result, context)
-        else:
-            _cms = _pi.result
+        les = self._get_metadata_statement(json_ms, cls, context, lazy,
+                                           priority, first_valid)
 
-        logger.debug('After filtering for correct usage: {}'.format(_cms))
+        if _key is not None and les:
+            _exp = chain_exp(les)
+            if _exp:
+                # What the caller gets may be modified
+                _les = [le.copy() for le in les]
+                self.results.set(_key, _les, _exp, size=chain_size(_les))
+        return les
 
-        if _cms:
-            return self.evaluate_metadata_statement(_cms)
-        else:
+    def _get_metadata_statement(self, json_ms, cls, context, lazy, priority,
+                                first_valid):
+        # Each signed statement is only parsed once
+        _parsed = {}
+        try:
+            _skip = self.prescan(json_ms, context, _parsed)
+        except LimitExceeded as err:
+            logger.error('Gave up unpacking: {}'.format(err))
             return []
 
+        if priority and first_valid:
+            _fos = set()
+            for param in ['metadata_statements', 'metadata_statement_uris']:
+                if param in json_ms:
+                    _fos.update(json_ms[param].keys())
+
+            # The limits are for the request, not for each federation
+            _budget = Budget(self.max_verifications, self.fetch_timeout)
+            for fo in priority:
+                if fo not in _fos:
+                    continue
+                les = self._unpack_and_evaluate(json_ms, cls, context, lazy,
+                                                _skip, liss=[fo],
+                                                budget=_budget,
+                                                parsed=_parsed)
+                if les:
+                    return les
+                logger.info('Could not use statement from {}'.format(fo))
+                _fos.discard(fo)
+
+            # Federations not on the priority list all come last
+            if not _fos:
+                return []
+            return self._unpack_and_evaluate(json_ms, cls, context, lazy,
+                                             _skip, liss=list(_fos),
+                                             budget=_budget, parsed=_parsed)
+
+        les = self._unpack_and_evaluate(json_ms, cls, context, lazy, _skip,
+                                        parsed=_parsed)
+        if priority:
+            _order = dict([(fo, n) for n, fo in enumerate(priority)])
+            les.sort(key=lambda le: _order.get(le.fo, len(priority)))
+        return les
+
     def add_signing_keys(self, statement):
         """
         Adding signing keys by value to a statement.
@@ -35,6 +35,8 @@ class FileSystem(object):
         self.fdir = fdir
         self.fmtime = {}
         self.db = {}
+        # Changes every time the content of the database changes
+        self.generation = 0
         self.key_conv = key_conv or {}
         self.value_conv = value_conv or {}
         if not os.path.isdir(fdir):
@@ -57,6 +59,7 @@ class FileSystem(object):
             logger.info("File content change in {}".format(item))
             fname = os.path.join(self.fdir, item)
             self.db[item] = self._read_info(fname)
+            self.generation += 1
 
         return self.db[item]
 
@@ -89,6 +92,7 @@ class FileSystem(object):
 
         self.db[_key] = value
         self.fmtime[_key] = self.get_mtime(fname)
+        self.generation += 1
 
     def __delitem__(self, key):
         fname = os.path.join(self.fdir, key)
@@ -99,6 +103,13 @@ class FileSystem(object):
             del self.db[key]
         except KeyError:
             pass
+        else:
+            self.generation += 1
+
+        try:
+            del self.fmtime[key]
+        except KeyError:
+            pass
 
     def keys(self):
         """
@@ -179,17 +190,30 @@ class FileSystem(object):
         if not os.path.isdir(self.fdir):
             os.makedirs(self.fdir)
             #raise ValueError('No such directory: {}'.format(self.fdir))
+        _files = set()
         for f in os.listdir(self.fdir):
             fname = os.path.join(self.fdir, f)
             if not os.path.isfile(fname):
                 continue
+            _files.add(f)
             if f in self.fmtime:
                 if self.is_changed(f):
                     self.db[f] = self._read_info(fname)
+                    self.generation += 1
             else:
                 mtime = self.get_mtime(fname)
                 self.db[f] = self._read_info(fname)
                 self.fmtime[f] = mtime
+                self.generation += 1
+
+        # Files that has been removed by someone else
+        for f in set(self.db.keys()).difference(_files):
+            del self.db[f]
+            try:
+                del self.fmtime[f]
+            except KeyError:
+                pass
+            self.generation += 1
 
     def items(self):
         """
@@ -1,23 +1,44 @@
 import copy
+import hashlib
 import json
 import logging
 import time
+from collections import deque
+
+try:
+    from types import MappingProxyType
+except ImportError:  # Python 2, no read-only views
+    MappingProxyType = dict
+
+from concurrent.futures import Future
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError
+from concurrent.futures import as_completed
 
 from oic.utils.time_util import utc_time_sans_frac
 
 from fedoidc import ClientMetadataStatement
 from fedoidc import DoNotCompare
+from fedoidc import KeyJar
+from fedoidc import KeyJarOverlay
 from fedoidc import IgnoreKeys
 from fedoidc import MetadataStatementError
-from fedoidc import is_lesser
+from fedoidc import ParsedJWS
+from fedoidc import lesser_comparator
 from fedoidc import unfurl
+from fedoidc import verification_keys
+from fedoidc.cache import ExpiringCache
+from fedoidc.cache import HTTPCache
 from jwkest import BadSignature
 from jwkest.jws import JWSException
+from jwkest.jws import SIGNER_ALGS
 
 from oic.oauth2.message import Message
 from oic.oauth2.message import MissingSigningKey
 from oic.utils.jwt import JWT
 from oic.utils.keyio import build_keyjar
+from six import integer_types
+from six import string_types
 
 __author__ = 'roland'
 
@@ -29,6 +50,9 @@ class ParseError(Exception):
 
 
 class ParseInfo(object):
+    __slots__ = ('input', 'parsed_statement', 'error', 'result', 'branch',
+                 'keyjar', 'signing_keys', 'les')
+
     def __init__(self):
         self.input = None
         self.parsed_statement = []
@@ -37,6 +61,84 @@ class ParseInfo(object):
         self.branch = {}
         self.keyjar = None
         self.signing_keys = None
+        self.les = None
+
+
+class Policy(object):
+    """
+    The claims of a superior compiled into a form that makes it cheap to
+    evaluate many subordinate metadata statements against them.
+    """
+
+    def __init__(self, claims):
+        """
+        :param claims: The flattened claims of the superior as a dictionary
+        """
+        self.ignore = frozenset(DoNotCompare)
+        # claim name -> (value, comparator)
+        self.claims = dict(
+            [(k, (v, lesser_comparator(v))) for k, v in claims.items()
+             if k not in self.ignore])
+        self.names = frozenset(self.claims.keys())
+
+    def eval(self, orig, signer=''):
+        """
+        Apply the less or equal algorithm to a set of claims.
+
+        :param orig: The subordinates claims
+        :param signer: Who vouched for the subordinates claims
+        :return: Tuple of the resulting claims and a list of errors
+        """
+        _le = {}
+        _err = []
+        for k, (v, _cmp) in self.claims.items():
+            if k in orig:
+                if _cmp(orig[k]):
+                    _le[k] = v
+                else:
+                    _err.append({'claim': k, 'policy': orig[k], 'err': v,
+                                 'signer': signer})
+            else:
+                _le[k] = v
+
+        for k, v in orig.items():
+            if k in self.ignore or k in _le:
+                continue
+            _le[k] = v
+
+        return _le, _err
+
+    def eval_many(self, origs, signer=''):
+        """
+        Apply the less or equal algorithm to a number of sets of claims.
+        The work is done claim by claim over the whole batch.
+
+        :param origs: List of the subordinates claims
+        :param signer: Who vouched for the subordinates claims
+        :return: List of (resulting claims, errors) tuples, one per set
+            of claims.
+        """
+        _les = [{} for _ in origs]
+        _errs = [[] for _ in origs]
+        _batch = list(zip(origs, _les, _errs))
+        for k, (v, _cmp) in self.claims.items():
+            for orig, _le, _err in _batch:
+                if k in orig:
+                    if _cmp(orig[k]):
+                        _le[k] = v
+                    else:
+                        _err.append({'claim': k, 'policy': orig[k], 'err': v,
+                                     'signer': signer})
+                else:
+                    _le[k] = v
+
+        _ignore = self.ignore
+        for orig, _le, _ in _batch:
+            for k, v in orig.items():
+                if k not in _le and k not in _ignore:
+                    _le[k] = v
+
+        return [(_le, _err) for _, _le, _err in _batch]
 
 
 class LessOrEqual(object):
@@ -44,6 +146,8 @@ class LessOrEqual(object):
     Class in which to store the parse result from flattening a compounded
     metadata statement.
     """
+    __slots__ = ('fo', 'iss', 'sup', 'err', '_le', 'exp', 'min_exp',
+                 'signing_keys', '_policy', '_unprotected', '_orig')
 
     def __init__(self, iss='', sup=None, exp=0, signing_keys=None, **kwargs):
         """
@@ -54,8 +158,11 @@ class LessOrEqual(object):
         """
         if sup:
             self.fo = sup.fo
+            #: The earliest expiration time in the chain
+            self.min_exp = min(exp, sup.min_exp)
         else:
             self.fo = iss
+            self.min_exp = exp
 
         self.iss = iss
         self.sup = sup
@@ -64,8 +171,24 @@ class LessOrEqual(object):
         self.exp = exp
         self.signing_keys = signing_keys
 
+    @property
+    def le(self):
+        if self._orig is not None:
+            self._eval_rest()
+        return self._le
+
+    @le.setter
+    def le(self, value):
+        self._orig = None
+        self._le = value
+        # Anything computed from the claims has to be redone
+        self._policy = None
+        self._unprotected = None
+
     def __setitem__(self, key, value):
         self.le[key] = value
+        self._policy = None
+        self._unprotected = None
 
     def keys(self):
         return self.le.keys()
@@ -74,10 +197,55 @@ class LessOrEqual(object):
         return self.le.items()
 
     def __getitem__(self, item):
-        return self.le[item]
+        if self._orig is not None:
+            try:
+                return self._le[item]
+            except KeyError:
+                return self._eval_claim(item)
+        return self._le[item]
 
     def __contains__(self, item):
-        return item in self.le
+        if self._orig is not None:
+            _policy = self.sup.policy()
+            if item in _policy.names:
+                return True
+            return item in self._orig and item not in _policy.ignore
+        return item in self._le
+
+    def _eval_claim(self, key):
+        """
+        Evaluate one claim when doing lazy evaluation.
+
+        :param key: The name of the claim
+        :return: The resulting value of the claim
+        """
+        _policy = self.sup.policy()
+        try:
+            v, _cmp = _policy.claims[key]
+        except KeyError:
+            if key in _policy.ignore:
+                raise KeyError(key)
+            val = self._orig[key]
+        else:
+            if key not in self._orig:
+                val = v
+            elif _cmp(self._orig[key]):
+                val = v
+            else:
+                val = self._orig[key]
+                self.err.append({'claim': key, 'policy': val, 'err': v,
+                                 'signer': self.iss})
+
+        self._le[key] = val
+        return val
+
+    def _eval_rest(self):
+        """
+        Evaluate all the claims that has not been evaluated yet.
+        """
+        _le, _err = self.sup.policy().eval(self._orig, self.iss)
+        self.le = _le
+        self.err = _err
 
     def sup_items(self):
         """
@@ -88,44 +256,52 @@ class LessOrEqual(object):
         else:
             return {}
 
-    def eval(self, orig):
+    def policy(self):
+        """
+        The claims of this instance compiled for use when evaluating
+        subordinate metadata statements. Compiled once and then reused.
+
+        :return: A :py:class:`Policy` instance
+        """
+        if self._policy is None:
+            self._policy = Policy(self.le)
+        return self._policy
+
+    def eval(self, orig, lazy=False):
         """
         Apply the less or equal algorithm on the ordered list of metadata
         statements
         
         :param orig: Start values
-        :param signer: Who vouched for this information
+        :param lazy: If True a claim is not evaluated until it is asked for.
+            Errors are then added to *err* as claims are evaluated.
+            Accessing *le*, *keys()* or *items()* evaluates all claims.
         :return:
         """
-        _le = {}
-        _err = []
-        for k, v in self.sup_items():
-            if k in DoNotCompare:
-                continue
-            if k in orig:
-                if is_lesser(orig[k], v):
-                    _le[k] = v
-                else:
-                    _err.append({'claim': k, 'policy': orig[k], 'err': v,
-                                 'signer': self.iss})
-            else:
-                _le[k] = v
+        if lazy and self.sup:
+            self.le = {}
+            self.err = []
+            self._orig = orig
+            return
 
-        for k, v in orig.items():
-            if k in DoNotCompare:
-                continue
-            if k not in _le:
-                _le[k] = v
+        if self.sup:
+            _le, _err = self.sup.policy().eval(orig, self.iss)
+        else:
+            _le = dict([(k, v) for k, v in orig.items()
+                        if k not in DoNotCompare])
+            _err = []
 
         self.le = _le
         self.err = _err
 
     def protected_claims(self):
         """
-        Someone in the list of signers has said this information is OK
+        Someone in the list of signers has said this information is OK.
+        The superiors may be shared with other instances so what is
+        returned is a read-only view, make a copy if it has to be modified.
         """
         if self.sup:
-            return self.sup.le
+            return MappingProxyType(self.sup.le)
 
     def unprotected_and_protected_claims(self):
         """
@@ -133,25 +309,44 @@ class LessOrEqual(object):
         verified information beats self-asserted so if there is both 
         self-asserted and verified values for a claim then only the verified
         will be returned.
+        The result is computed once, what is returned is a read-only view.
         """
         if self.sup:
-            res = {}
-            for k, v in self.le.items():
-                if k not in self.sup.le:
-                    res[k] = v
-            return res
+            if self._unprotected is None:
+                _sup = self.sup.le
+                self._unprotected = dict(
+                    [(k, v) for k, v in self.le.items() if k not in _sup])
+            return MappingProxyType(self._unprotected)
         else:
-            return self.le
+            return MappingProxyType(self.le)
 
-    def is_expired(self):
-        now = utc_time_sans_frac()
-        if self.exp < now:
-            logger.debug('is_expired: {} < {}'.format(self.exp, now))
+    def copy(self):
+        """
+        Make a copy that can be modified without affecting this instance.
+        The superiors are shared.
+
+        :return: A :py:class:`LessOrEqual` instance
+        """
+        le = LessOrEqual(iss=self.iss, sup=self.sup, exp=self.exp,
+                         signing_keys=self.signing_keys)
+        le.le = copy.deepcopy(self._le)
+        le._orig = self._orig
+        le.err = copy.deepcopy(self.err)
+        return le
+
+    def is_expired(self, now=0):
+        """
+        Whether this or any of the superiors has expired.
+
+        :param now: Current time, seconds since epoch.
+        :return: True/False
+        """
+        if not now:
+            now = utc_time_sans_frac()
+        if self.min_exp < now:
+            logger.debug('is_expired: {} < {}'.format(self.min_exp, now))
             return True
-        if self.sup:
-            return self.sup.is_expired()
-        else:
-            return False
+        return False
 
 
 def le_dict(les):
@@ -174,13 +369,348 @@ def get_fo(ms):
         return get_fo(_ms)
 
 
+def statement_digest(ms):
+    """
+    A digest over the content of a metadata statement.
+
+    :param ms: Metadata statement as a dictionary
+    :return: Hex encoded SHA-256 digest
+    """
+    _str = json.dumps(ms, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(_str.encode('utf-8')).hexdigest()
+
+
+def chain_exp(les):
+    """
+    The earliest expiration time in a number of LessOrEqual chains.
+
+    :param les: list of :py:class:`LessOrEqual` instances
+    :return: Seconds since epoch, 0 if some part of a chain has no
+        expiration time.
+    """
+    if not les:
+        return 0
+    return min([le.min_exp for le in les])
+
+
+def chain_size(les):
+    """
+    Estimate of how much memory a number of LessOrEqual chains hold on
+    to, counted as the size of the claims serialized as JSON. Superiors
+    shared between chains are only counted once.
+
+    :param les: list of :py:class:`LessOrEqual` instances
+    :return: Size in bytes
+    """
+    _size = 0
+    _seen = set()
+    for le in les:
+        while le is not None and id(le) not in _seen:
+            _seen.add(id(le))
+            for _part in [le._le, le._orig, le.err]:
+                if _part:
+                    _size += len(json.dumps(_part, default=str))
+            le = le.sup
+    return _size
+
+
+class LimitExceeded(ParseError):
+    pass
+
+
+class Budget(object):
+    """
+    Keeps track of the work done while unpacking one compounded metadata
+    statement.
+    """
+
+    def __init__(self, max_verifications=0, timeout=0):
+        """
+        :param max_verifications: Max number of signature verifications.
+            0 means no limit.
+        :param timeout: Seconds from now until all fetching of metadata
+            statements has to be done. 0 means no limit.
+        """
+        self.max_verifications = max_verifications
+        self.verifications = 0
+        if timeout:
+            self.deadline = time.time() + timeout
+        else:
+            self.deadline = 0
+
+    def spend(self, num=1):
+        """
+        Register that signature verifications has been done.
+
+        :param num: Number of verifications
+        """
+        self.verifications += num
+        if self.max_verifications and \
+                self.verifications > self.max_verifications:
+            raise LimitExceeded(
+                'More than {} signature verifications needed'.format(
+                    self.max_verifications))
+
+    def time_left(self):
+        """
+        How much time there is left before the deadline.
+
+        :return: Seconds, None if there is no deadline
+        """
+        if not self.deadline:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+
+def superior_exp(ms):
+    """
+    When a verified metadata statement, or any of the statements it
+    contains, expires.
+
+    :param ms: A verified metadata statement
+    :return: Seconds since epoch, 0 if some statement has no expiration time
+    """
+    _exp = []
+    _stack = [ms]
+    while _stack:
+        _ms = _stack.pop()
+        try:
+            _exp.append(_ms['exp'])
+        except KeyError:
+            return 0
+        _stack.extend(_ms.get('metadata_statements', {}).values())
+    return min(_exp)
+
+
+class TrustedIntermediates(object):
+    """
+    Signing keys of intermediates, organisations and the like, that a FO
+    has vouched for in a verified metadata statement. The keys are trusted
+    until the vouching statement, or any statement above it, expires.
+    Maps (FO ID, issuer ID) to the signed statement that vouched for the
+    keys, the context it was verified in, the verified content of that
+    statement and the keys as a KeyBundle.
+    """
+
+    def __init__(self, max_entries=1000):
+        """
+        :param max_entries: Max number of (FO, issuer) pairs to remember.
+            0 turns the store off.
+        """
+        self.db = ExpiringCache(max_entries)
+        self.generation = None
+
+    def bind(self, generation):
+        """
+        Make sure that what is in the store was verified using the present
+        FO keys.
+
+        :param generation: Generation of the FO bundle
+        :return: This instance or None if the store is turned off
+        """
+        if self.db.max_entries <= 0:
+            return None
+        if generation != self.generation:
+            self.db.clear()
+            self.generation = generation
+        return self
+
+    def add(self, fo, iss, jws, superior, key_bundle, context=''):
+        """
+        Remember the signing keys of an intermediate.
+
+        :param fo: The FO ID
+        :param iss: The ID of the intermediate
+        :param jws: The signed metadata statement that vouched for the keys
+        :param superior: The verified content of the signed statement
+        :param key_bundle: The signing keys as a KeyBundle
+        :param context: The federation_usage the statement was verified for
+        """
+        _exp = superior_exp(superior)
+        if _exp:
+            self.db.set((fo, iss),
+                        (jws, context, superior.to_dict(), key_bundle), _exp)
+
+    def key_bundle(self, fo, iss, jws=''):
+        """
+        The trusted signing keys of an intermediate.
+
+        :param fo: The FO ID
+        :param iss: The ID of the intermediate
+        :param jws: If given, the keys are only returned if they were
+            vouched for by this signed metadata statement.
+        :return: A KeyBundle instance or None
+        """
+        try:
+            _jws, _, _, _kb = self.db[(fo, iss)]
+        except KeyError:
+            return None
+        if jws and jws != _jws:
+            return None
+        return _kb
+
+    def superior(self, fo, iss, jws, context=''):
+        """
+        The verified content of a signed metadata statement that has
+        vouched for the keys of an intermediate.
+
+        :param fo: The FO ID
+        :param iss: The ID of the intermediate
+        :param jws: The signed metadata statement
+        :param context: The federation_usage the statement is going to be
+            used for. Statements verified for another context are not
+            returned since the chains below them might not be usable in
+            this context.
+        :return: A dictionary or None if the statement is not known
+        """
+        try:
+            _jws, _context, _sup, _ = self.db[(fo, iss)]
+        except KeyError:
+            return None
+        if jws != _jws or context != _context:
+            return None
+        return _sup
+
+
+class _Node(object):
+    """
+    A metadata statement in the tree that is being unpacked. A signed
+    statement that appears more then once at the same depth is represented
+    by one node, so the tree is really a directed acyclic graph.
+    """
+
+    def __init__(self, json_ms, cls, pjws=None, depth=0, key=None, skip=None,
+                 context='', trusted=None, nodes=None, failed=None,
+                 parsed=None):
+        self.json_ms = json_ms
+        self.cls = cls
+        self.pjws = pjws
+        self.depth = depth
+        self.key = key  # The signed statement as it appeared in the superior
+        self.pr = None
+        self.ms_flag = False
+        self.slots = None  # _Node instances or (key, Future) tuples
+        self.skip = skip  # Signed statements that should not be unpacked
+        self.context = context  # Expected federation_usage
+        self.trusted = trusted  # A TrustedIntermediates instance or None
+        self.failed = failed  # Cache of statements that failed or None
+        self.fos = {}  # Signed statement to the FO ID it was listed under
+        # All the nodes in the graph, keyed by signed statement and depth
+        self.nodes = {} if nodes is None else nodes
+        # Signed statements already parsed, by prescan for instance
+        self.parsed = {} if parsed is None else parsed
+        self.done = False
+
+
+def well_formed(json_ms):
+    """
+    Check, before anything has been verified, that the claims that are
+    looked at while unpacking have the expected types.
+
+    :param json_ms: Metadata statement as a dictionary
+    :return: True/False
+    """
+    if not isinstance(json_ms, dict):
+        return False
+    if 'exp' in json_ms:
+        _exp = json_ms['exp']
+        if isinstance(_exp, bool) or \
+                not isinstance(_exp, integer_types + (float,)):
+            return False
+    if 'iss' in json_ms and not isinstance(json_ms['iss'], string_types):
+        return False
+    for param in ['metadata_statements', 'metadata_statement_uris']:
+        if param in json_ms and not isinstance(json_ms[param], dict):
+            return False
+    return True
+
+
+def wrong_usage(json_ms, context):
+    """
+    Check whether an innermost metadata statement is marked to be used in
+    another context.
+
+    :param json_ms: Metadata statement as a dictionary
+    :param context: In which context the statement is expected to be used
+    :return: True if the statement is innermost and meant for another
+        context otherwise False
+    """
+    if not context:
+        return False
+    if 'metadata_statements' in json_ms or \
+            'metadata_statement_uris' in json_ms:
+        return False
+    try:
+        return json_ms['federation_usage'] != context
+    except KeyError:
+        return False
+
+
+def refers_to_uris(jwt_ms):
+    """
+    Check, without verifying any signatures, whether a signed metadata
+    statement or any of the statements it contains refers to metadata
+    statements by URI.
+
+    :param jwt_ms: Signed metadata statement as a string or a
+        :py:class:`fedoidc.ParsedJWS` instance
+    :return: True/False
+    """
+    _stack = [jwt_ms]
+    while _stack:
+        _ms = unfurl(_stack.pop())
+        if 'metadata_statement_uris' in _ms:
+            return True
+        _stack.extend(_ms.get('metadata_statements', {}).values())
+    return False
+
+
+def unpack_branch(jwks, jwt_ms, depth=0, max_depth=0, max_branches=0,
+                  max_verifications=0, skip=None, lean=False, context=''):
+    """
+    Unpack one signed metadata statement. Meant to be run in a separate
+    process, hence only simple types as arguments.
+
+    :param jwks: Dictionary with issuer IDs as keys and JWKSs as values
+    :param jwt_ms: Signed metadata statement
+    :param depth: Where in the tree this statement is
+    :param max_depth: See :py:class:`Operator`
+    :param max_branches: See :py:class:`Operator`
+    :param max_verifications: Signature verifications this branch may use
+    :param skip: Signed metadata statements that should not be unpacked
+    :param lean: See :py:class:`Operator`
+    :param context: In which context the statement is expected to be used
+    :return: Tuple of a ParseInfo instance and the number of signature
+        verifications that was done.
+    """
+    keyjar = KeyJar()
+    for iss, _jwks in jwks.items():
+        keyjar.import_jwks(_jwks, iss)
+
+    _op = Operator(verified_cache_size=0, uri_cache_size=0,
+                   flatten_cache_size=0, trusted_cache_size=0,
+                   failed_cache_size=0, lean=lean,
+                   max_depth=max_depth, max_branches=max_branches)
+    _budget = Budget(max_verifications)
+    _pjws = ParsedJWS(jwt_ms)
+    _pi = _op._unpack(_pjws.payload, keyjar, ClientMetadataStatement, _pjws,
+                      budget=_budget, depth=depth, skip=skip,
+                      context=context)
+    return _pi, _budget.verifications
+
+
 class Operator(object):
     """
     An operator in a OIDC federation.
     """
 
     def __init__(self, keyjar=None, jwks_bundle=None, httpcli=None, iss=None,
-                 lifetime=3600):
+                 lifetime=3600, verified_cache_size=1000, fetch_workers=8,
+                 fetch_timeout=10, uri_cache_size=1000, process_pool=None,
+                 max_depth=10, max_branches=20, max_verifications=100,
+                 allowed_algs=None, flatten_cache_size=1000, lean=False,
+                 trusted_cache_size=1000, failed_cache_size=1000,
+                 failed_ttl=60):
         """
 
         :param keyjar: Contains the operators signing keys
@@ -192,13 +722,65 @@ class Operator(object):
         :param iss: Issuer ID
         :param lifetime: Default lifetime of signed statements produced
             by this signer.
+        :param verified_cache_size: Max number of verified signed statements
+            to remember. 0 turns the cache off.
+        :param fetch_workers: Max number of metadata statements that are
+            fetched in parallel.
+        :param fetch_timeout: Deadline, in seconds, for fetching all the
+            metadata statements referenced in one compounded statement.
+            0 means no limit.
+        :param uri_cache_size: Max number of responses from
+            metadata_statement_uris to keep. 0 turns the cache off.
+        :param process_pool: A concurrent.futures.ProcessPoolExecutor
+            instance. If given, statements from different federations are
+            verified in parallel using this pool.
+        :param max_depth: How deeply metadata statements may be nested.
+            0 means no limit.
+        :param max_branches: Max number of metadata statements that may be
+            included in, or referenced from, one statement. 0 means no limit.
+        :param max_verifications: Max number of signature verifications
+            that may be done while unpacking one compounded metadata
+            statement. 0 means no limit.
+        :param allowed_algs: Signing algorithms that are accepted on
+            metadata statements. Default is all that are supported except
+            'none'.
+        :param flatten_cache_size: Max number of flattened intermediate
+            metadata statements to remember. 0 turns the cache off.
+        :param lean: If True the ParseInfo instances produced when unpacking
+            does not keep the input or the branches, unless debug logging
+            is on.
+        :param trusted_cache_size: Max number of intermediates to remember
+            the FO vouched for signing keys of. 0 turns the store off.
+        :param failed_cache_size: Max number of signed statements that
+            could not be verified to remember. 0 turns the cache off.
+        :param failed_ttl: For how many seconds a signed statement that
+            could not be verified should be remembered.
         """
         self.keyjar = keyjar
         self.jwks_bundle = jwks_bundle
         self.httpcli = httpcli
         self.iss = iss
-        self.failed = {}
+        self.failed = ExpiringCache(failed_cache_size)
+        self.failed_ttl = failed_ttl
+        self._failed_generation = None
         self.lifetime = lifetime
+        self.verified = ExpiringCache(verified_cache_size)
+        self.fetch_workers = fetch_workers
+        self.fetch_timeout = fetch_timeout
+        if uri_cache_size:
+            self.uri_cache = HTTPCache(uri_cache_size)
+        else:
+            self.uri_cache = None
+        self.process_pool = process_pool
+        self.max_depth = max_depth
+        self.max_branches = max_branches
+        self.max_verifications = max_verifications
+        if allowed_algs is None:
+            allowed_algs = [a for a in SIGNER_ALGS.keys() if a != 'none']
+        self.allowed_algs = allowed_algs
+        self.flattened = ExpiringCache(flatten_cache_size)
+        self.lean = lean
+        self.trusted = TrustedIntermediates(trusted_cache_size)
 
     def signing_keys_as_jwks(self):
         """
@@ -212,85 +794,381 @@ class Operator(object):
                   self.keyjar.get_signing_key(owner=self.iss)]
         return {'keys': _l}
 
-    def _ums(self, pr, meta_s, keyjar):
+    def _verify(self, pjws, keyjar, cls, budget=None, failed=None):
+        """
+        Verify the signature of a signed metadata statement. Statements that
+        has been verified before are remembered, keyed by the JWS and the kid
+        of the verifying key, until they expire.
+        Statements that could not be verified are remembered together with
+        the keys that were tried. The verdict is only reused if exactly the
+        same keys are to be used again, since the keys depend on the
+        rest of the compounded statement they were found in.
+
+        :param pjws: Metadata statement as a :py:class:`fedoidc.ParsedJWS`
+            instance
+        :param keyjar: A KeyJar that should contain the verification key
+        :param cls: What class to map the metadata into
+        :param budget: A :py:class:`Budget` instance
+        :param failed: Cache of signed statements that could not be
+            verified or None.
+        :return: A cls instance
+        """
+        _kid = pjws.kid
+        _alg = pjws.alg
+        _iss = pjws.payload.get('iss')
+
+        if _iss is None or _alg in ['', 'none']:
+            # Let pyoidc deal with the odd cases
+            if budget is not None:
+                budget.spend()
+            return cls().from_jwt(pjws.jws, keyjar=keyjar)
+
+        # The issuers keys or my own
+        _keys = verification_keys(keyjar, _iss, _kid, _alg)
+        if not _keys:
+            _keys = verification_keys(keyjar, '', _kid, _alg)
+
+        if _kid and _keys:
+            try:
+                _vkey, _info = self.verified[(pjws.jws, _kid)]
+            except KeyError:
+                pass
+            else:
+                # The key must still be one I trust
+                if _vkey in _keys:
+                    logger.debug('Verified signed JWT found in cache')
+                    _res = cls().from_dict(copy.deepcopy(_info))
+                    _res.jws_header = pjws.header
+                    _res.jwt = pjws.jws
+                    return _res
+
+        if failed is not None:
+            try:
+                _tried, _err = failed[(pjws.jws, _kid, _alg)]
+            except KeyError:
+                pass
+            else:
+                if _tried == _keys:
+                    logger.info('Metadata statement known to be bad')
+                    raise _err
+
         try:
-            _pi = self.unpack_metadata_statement(
-                jwt_ms=meta_s, keyjar=keyjar)
-        except (JWSException, BadSignature,
-                MissingSigningKey) as err:
-            logger.error('Encountered: {}'.format(err))
-            pr.error[meta_s] = err
-        else:
-            pr.branch[meta_s] = _pi
-            if _pi.result:
-                pr.parsed_statement.append(_pi.result)
-                pr.signing_keys = _pi.signing_keys
+            if not _keys:
+                raise MissingSigningKey('alg={}'.format(_alg))
+
+            if budget is not None:
+                budget.spend()
+            _vkey = pjws.verify(_keys)
+        except (BadSignature, MissingSigningKey) as err:
+            if failed is not None:
+                failed.set((pjws.jws, _kid, _alg), (_keys, err),
+                           utc_time_sans_frac() + self.failed_ttl)
+            raise
+        _res = cls().from_dict(pjws.payload)
+        _res.jws_header = pjws.header
+        _res.jwt = pjws.jws
+
+        if _kid and 'exp' in _res:
+            self.verified.set((pjws.jws, _kid),
+                              (_vkey, copy.deepcopy(_res.to_dict())),
+                              _res['exp'])
+        return _res
+
+    @staticmethod
+    def _add_branch(pr, meta_s, pi, keep=True):
+        if keep:
+            pr.branch[meta_s] = pi
+        if pi.result:
+            pr.parsed_statement.append(pi.result)
+            pr.signing_keys = pi.signing_keys
         return pr
 
-    def _unpack(self, json_ms, keyjar, cls, jwt_ms=None, liss=None):
+    def _keep_details(self):
         """
-        
-        :param json_ms: Metadata statement as a JSON document 
+        Whether input and branches should be kept in the ParseInfo instances
+        """
+        return not self.lean or logger.isEnabledFor(logging.DEBUG)
+
+    def _http_get(self, url):
+        if self.uri_cache is not None:
+            return self.uri_cache.fetch(self.httpcli, url)
+        else:
+            return self.httpcli.http_request(url)
+
+    def _fetch(self, uris, budget):
+        """
+        Fetch a number of signed metadata statements in parallel.
+        Responses are returned as they arrive.
+
+        :param uris: dictionary with FO IDs as keys and URLs as values
+        :param budget: A :py:class:`Budget` instance, holds the deadline
+        :return: generator of (url, response) tuples
+        """
+        if not uris:
+            return
+
+        _timeout = budget.time_left()
+        if _timeout == 0:
+            raise ParseError(
+                'Timeout before fetching jws from {}'.format(
+                    list(uris.values())))
+
+        _pool = ThreadPoolExecutor(max_workers=min(len(uris),
+                                                   self.fetch_workers))
+        try:
+            _fut = dict([(_pool.submit(self._http_get, url), url)
+                         for url in uris.values()])
+            try:
+                for f in as_completed(_fut, timeout=_timeout):
+                    yield _fut[f], f.result()
+            except TimeoutError:
+                _missing = [u for f, u in _fut.items() if not f.done()]
+                raise ParseError(
+                    'Timeout while fetching jws from {}'.format(_missing))
+        finally:
+            # don't wait for stragglers
+            _pool.shutdown(wait=False)
+
+    def _add_sub_statement(self, node, meta_s, keyjar, budget, in_pool=False):
+        """
+        Add a signed metadata statement found in another statement to the
+        set of statements that should be unpacked.
+
+        :param node: The :py:class:`_Node` the statement was found in
+        :param meta_s: The signed metadata statement
         :param keyjar: A keyjar with the necessary FO keys
-        :param cls: What class to map the metadata into
-        :param jwt_ms: Metadata statement as a JWS 
-        :param liss: List of FO issuer IDs
-        :return: ParseInfo instance
+        :param budget: A :py:class:`Budget` instance
+        :param in_pool: Whether it should be unpacked in the process pool
+        """
+        if node.skip and meta_s in node.skip:
+            logger.info('Not unpacking unusable metadata statement')
+            node.pr.error[meta_s] = ParseError('Unusable metadata statement')
+            return
+
+        if node.failed is not None:
+            _err = node.failed.get(meta_s)
+            if _err is not None:
+                logger.info('Metadata statement known to be malformed')
+                node.pr.error[meta_s] = _err
+                return
+
+        _shared = node.nodes.get((meta_s, node.depth + 1))
+        if _shared is not None:
+            logger.debug('Metadata statement already being unpacked')
+            node.slots.append(_shared)
+            return
+
+        if node.trusted is not None and node.fos.get(meta_s):
+            _sup = node.trusted.superior(node.fos[meta_s],
+                                         node.json_ms.get('iss'), meta_s,
+                                         node.context)
+            if _sup is not None:
+                # No need to walk the chain again
+                logger.debug('Metadata statement vouched for earlier')
+                _pi = ParseInfo()
+                _pi.result = ClientMetadataStatement().from_dict(
+                    copy.deepcopy(_sup))
+                _fut = Future()
+                _fut.set_result((_pi, 0))
+                node.slots.append((meta_s, _fut))
+                return
+
+        try:
+            _pjws = node.parsed[meta_s]
+        except KeyError:
+            try:
+                _pjws = ParsedJWS(meta_s)
+            except JWSException as err:
+                logger.error('Encountered: {}'.format(err))
+                node.pr.error[meta_s] = err
+                # Does not depend on who sent it or which keys are around
+                if node.failed is not None:
+                    node.failed.set(meta_s, err,
+                                    utc_time_sans_frac() + self.failed_ttl)
+                return
+            node.parsed[meta_s] = _pjws
+
+        if wrong_usage(_pjws.payload, node.context):
+            logger.info('Not meant to be used for {}'.format(node.context))
+            node.pr.error[meta_s] = ParseError(
+                'Wrong federation_usage, expected {}'.format(node.context))
+            return
+
+        if in_pool and not refers_to_uris(_pjws):
+            _jwks = dict([(iss, keyjar.export_jwks(issuer=iss))
+                          for iss in keyjar.keys()])
+            if budget.max_verifications:
+                _left = max(
+                    budget.max_verifications - budget.verifications, 1)
+            else:
+                _left = 0
+            _fut = self.process_pool.submit(
+                unpack_branch, _jwks, meta_s, depth=node.depth + 1,
+                max_depth=self.max_depth, max_branches=self.max_branches,
+                max_verifications=_left,
+                skip=list(node.skip) if node.skip else None,
+                lean=self.lean, context=node.context)
+            node.slots.append((meta_s, _fut))
+        else:
+            _node = _Node(_pjws.payload, ClientMetadataStatement, _pjws,
+                          node.depth + 1, meta_s, node.skip, node.context,
+                          node.trusted, node.nodes, node.failed, node.parsed)
+            node.nodes[(meta_s, node.depth + 1)] = _node
+            node.slots.append(_node)
+
+    def _expand(self, node, keyjar, budget, liss=None):
         """
-        if liss is None:
-            liss = []
+        Find the metadata statements that are included in, or referenced
+        from, a metadata statement.
 
-        _pr = ParseInfo()
-        _pr.input = json_ms
-        ms_flag = False
+        :param node: A :py:class:`_Node` instance
+        :param keyjar: A keyjar with the necessary FO keys
+        :param budget: A :py:class:`Budget` instance
+        :param liss: List of FO issuer IDs
+        """
+        json_ms = node.json_ms
+        node.pr = ParseInfo()
+        if self._keep_details():
+            node.pr.input = json_ms
+        node.slots = []
+
+        _msl = []
+        _uris = {}
         if 'metadata_statements' in json_ms:
-            ms_flag = True
+            node.ms_flag = True
             for iss, _ms in json_ms['metadata_statements'].items():
-                if liss and iss not in liss:
-                    continue
-                _pr = self._ums(_pr, _ms, keyjar)
+                if not liss or iss in liss:
+                    _msl.append(_ms)
+                    node.fos[_ms] = iss
 
         if 'metadata_statement_uris' in json_ms:
-            ms_flag = True
+            node.ms_flag = True
             if self.httpcli:
-                for iss, url in json_ms['metadata_statement_uris'].items():
-                    if liss and iss not in liss:
-                        continue
-                    rsp = self.httpcli.http_request(url)
-                    if rsp.status_code == 200:
-                        _pr = self._ums(_pr, rsp.text, keyjar)
-                    else:
-                        raise ParseError(
-                            'Could not fetch jws from {}'.format(url))
+                _uris = dict(
+                    [(iss, url) for iss, url in
+                     json_ms['metadata_statement_uris'].items()
+                     if not liss or iss in liss])
+
+        _num = len(_msl) + len(_uris)
+        if not _num:
+            return
+
+        if self.max_branches and _num > self.max_branches:
+            raise LimitExceeded(
+                'Too many branches: {} > {}'.format(_num, self.max_branches))
+        if self.max_depth and node.depth + 1 > self.max_depth:
+            raise LimitExceeded(
+                'Metadata statements nested deeper then {}'.format(
+                    self.max_depth))
+
+        _in_pool = self.process_pool is not None and len(_msl) > 1
+        for _ms in _msl:
+            self._add_sub_statement(node, _ms, keyjar, budget, _in_pool)
+
+        _fos = dict([(url, iss) for iss, url in _uris.items()])
+        for url, rsp in self._fetch(_uris, budget):
+            if rsp.status_code == 200:
+                node.fos[rsp.text] = _fos[url]
+                self._add_sub_statement(node, rsp.text, keyjar, budget)
+            else:
+                raise ParseError('Could not fetch jws from {}'.format(url))
+
+    @staticmethod
+    def _signing_keys(node, meta_s, ms, keyjar):
+        """
+        The signing keys of the issuer of a statement, as found in a
+        verified statement it contains. If trusted intermediates are kept,
+        they are remembered, or picked up if they already are.
+
+        :param node: The :py:class:`_Node` the statement was found in
+        :param meta_s: The signed statement the keys were found in
+        :param ms: The verified content of that statement
+        :param keyjar: The keyjar that is used for this unpack
+        :return: A KeyBundle instance
+        """
+        _iss = node.json_ms['iss']
+        _fo = node.fos.get(meta_s)
+        _trusted = node.trusted
+        if _trusted is not None and _fo:
+            _kb = _trusted.key_bundle(_fo, _iss, meta_s)
+            if _kb is not None:
+                return _kb
+
+        _jwks = ms['signing_keys']
+        try:
+            _keys = _jwks['keys']
+        except KeyError:
+            raise ValueError('Not a proper JWKS')
+        _kb = keyjar.keybundle_cls(_keys, verify_ssl=keyjar.verify_ssl)
 
-        for _ms in _pr.parsed_statement:
-            if _ms:  # can be None
+        if _trusted is not None and _fo:
+            try:
+                _vouched = get_fo(ms) == _fo
+            except (KeyError, MetadataStatementError):
+                _vouched = False
+            if _vouched:
+                _trusted.add(_fo, _iss, meta_s, ms, _kb, node.context)
+        return _kb
+
+    def _finish(self, node, keyjar, budget):
+        """
+        Once all the metadata statements included in a statement has been
+        dealt with, verify the statement itself.
+
+        :param node: A :py:class:`_Node` instance
+        :param keyjar: A keyjar with the necessary FO keys
+        :param budget: A :py:class:`Budget` instance
+        """
+        _pr = node.pr
+        json_ms = node.json_ms
+        _keep = self._keep_details()
+
+        # Keep the original order
+        _found = []
+        for slot in node.slots:
+            if isinstance(slot, _Node):
+                meta_s, _pi = slot.key, slot.pr
+            else:
+                meta_s, f = slot
                 try:
-                    keyjar.import_jwks(_ms['signing_keys'], json_ms['iss'])
-                except KeyError:
-                    pass
-                else:
-                    logger.debug(
-                        'Loaded signing keys belonging to {} into the '
-                        'keyjar'.format(json_ms['iss']))
+                    _pi, _used = f.result()
+                except (JWSException, BadSignature, MissingSigningKey) as err:
+                    logger.error('Encountered: {}'.format(err))
+                    _pr.error[meta_s] = err
+                    continue
+                budget.spend(_used)
 
-        if ms_flag is True and not _pr.parsed_statement:
-            return _pr
+            _pr = self._add_branch(_pr, meta_s, _pi, _keep)
+            if _pi.result:
+                _found.append((meta_s, _pi.result))
 
-        if jwt_ms:
-            logger.debug("verifying signed JWT: {}".format(jwt_ms))
+        for meta_s, _ms in _found:
             try:
-                _pr.result = cls().from_jwt(jwt_ms, keyjar=keyjar)
+                _kb = self._signing_keys(node, meta_s, _ms, keyjar)
+                keyjar.add_kb(json_ms['iss'], _kb)
+            except KeyError:
+                pass
+            else:
+                logger.debug(
+                    'Loaded signing keys belonging to {} into the '
+                    'keyjar'.format(json_ms['iss']))
+
+        if node.ms_flag is True and not _pr.parsed_statement:
+            return
+
+        if node.pjws:
+            logger.debug("verifying signed JWT: {}".format(node.pjws.jws))
+            try:
+                _pr.result = self._verify(node.pjws, keyjar, node.cls, budget,
+                                          node.failed)
             except (JWSException, BadSignature, MissingSigningKey,
                     KeyError) as err:
                 logger.error('Encountered: {}'.format(err))
-                _pr.error[jwt_ms] = err
+                _pr.error[node.pjws.jws] = err
         else:
             _pr.result = json_ms
 
         if _pr.result and _pr.parsed_statement:
-            _prr = _pr.result
-
             _res = {}
             for x in _pr.parsed_statement:
                 if x:
@@ -298,40 +1176,348 @@ class Operator(object):
 
             _msg = Message(**_res)
             logger.debug('Resulting metadata statement: {}'.format(_msg))
+            if _pr.result is json_ms:  # Leave the callers document alone
+                _pr.result = json_ms.copy()
             _pr.result['metadata_statements'] = _msg
-        return _pr
+
+    def _unpack(self, json_ms, keyjar, cls, jwt_ms=None, liss=None,
+                budget=None, depth=0, skip=None, context='', trusted=None,
+                failed=None, parsed=None):
+        """
+        Unpack and verify a compounded metadata statement. The tree of
+        statements is walked depth first using an explicit stack. The
+        limits set on this instance are checked as the tree is walked.
+        
+        :param json_ms: Metadata statement as a JSON document 
+        :param keyjar: A keyjar with the necessary FO keys
+        :param cls: What class to map the metadata into
+        :param jwt_ms: Metadata statement as a :py:class:`fedoidc.ParsedJWS`
+            instance
+        :param liss: List of FO issuer IDs
+        :param budget: A :py:class:`Budget` instance
+        :param depth: At which depth in a tree this statement is
+        :param skip: Signed metadata statements that should not be unpacked
+        :param context: In which context the statement is expected to be
+            used. Statements meant for other contexts are dropped before
+            their signatures are verified.
+        :param trusted: A :py:class:`TrustedIntermediates` instance to use,
+            only if keyjar contains the keys of the FO bundle.
+        :param failed: Cache of signed statements that could not be
+            verified, only if keyjar contains the keys of the FO bundle.
+        :param parsed: Signed statements already parsed, see
+            :py:meth:`unpack_metadata_statement`
+        :return: ParseInfo instance
+        """
+        if budget is None:
+            budget = Budget(self.max_verifications, self.fetch_timeout)
+
+        if wrong_usage(json_ms, context):
+            logger.info('Not meant to be used for {}'.format(context))
+            _pr = ParseInfo()
+            if self._keep_details():
+                _pr.input = json_ms
+            return _pr
+
+        root = _Node(json_ms, cls, jwt_ms, depth, skip=skip, context=context,
+                     trusted=trusted, failed=failed, parsed=parsed)
+        _stack = [root]
+        while _stack:
+            node = _stack[-1]
+            if node.done:  # Shared with a node that came before
+                _stack.pop()
+                continue
+
+            if node.slots is None:
+                if node is root:
+                    self._expand(node, keyjar, budget, liss)
+                else:
+                    self._expand(node, keyjar, budget)
+                _sub = [s for s in node.slots if isinstance(s, _Node)]
+                if _sub:
+                    _stack.extend(reversed(_sub))
+                    continue
+
+            _stack.pop()
+            self._finish(node, keyjar, budget)
+            node.done = True
+
+        return root.pr
+
+    def _failed(self, generation):
+        """
+        The cache of signed statements that could not be verified, emptied
+        if the FO keys has changed since it was last used.
+
+        :param generation: Generation of the FO bundle
+        :return: An :py:class:`fedoidc.cache.ExpiringCache` instance or
+            None if the cache is turned off
+        """
+        if self.failed.max_entries <= 0:
+            return None
+        if generation != self._failed_generation:
+            self.failed.clear()
+            self._failed_generation = generation
+        return self.failed
 
     def unpack_metadata_statement(self, json_ms=None, jwt_ms='', keyjar=None,
-                                  cls=ClientMetadataStatement, liss=None):
+                                  cls=ClientMetadataStatement, liss=None,
+                                  skip=None, context='', budget=None,
+                                  parsed=None):
         """
         Starting with a signed JWT or a JSON document unpack and verify all
         the separate metadata statements.
+        If the keys of the FO bundle are used, signed statements that could
+        not be verified are remembered for a while. Malformed statements are
+        then rejected without being looked at again, a bad signature only
+        if the same keys are to be used again.
 
         :param json_ms: Metadata statement as a JSON document
-        :param jwt_ms: Metadata statement as JWT
+        :param jwt_ms: Metadata statement as JWT, either as a string or as a
+            :py:class:`fedoidc.ParsedJWS` instance
         :param keyjar: Keys that should be used to verify the signature of the
-            document
+            document. Signing keys found while unpacking are not added to it.
         :param cls: What type (Class) of metadata statement this is
         :param liss: list of FO identifiers that matters. The rest will be 
             ignored
+        :param skip: Signed metadata statements that should not be unpacked,
+            as produced by :py:meth:`prescan`
+        :param context: In which context the metadata statement is expected
+            to be used. Branches meant for other contexts are dropped.
+        :param budget: A :py:class:`Budget` instance, if the verifications
+            and the fetch deadline should be shared with other calls.
+        :param parsed: Dictionary with signed metadata statements as keys
+            and :py:class:`fedoidc.ParsedJWS` instances as values, as
+            filled in by :py:meth:`prescan`. Statements found in it are not
+            parsed again.
         :return: A ParseInfo instance
         """
 
         if not keyjar:
             keyjar = self.jwks_bundle.as_keyjar()
+            # What is known about intermediates and statements that could
+            # not be verified is only valid for these keys
+            _gen = self.jwks_bundle.current_generation()
+            _trusted = self.trusted.bind(_gen)
+            _failed = self._failed(_gen)
+        else:
+            # Signing keys found on the way are only of interest while
+            # unpacking this statement.
+            keyjar = KeyJarOverlay(keyjar)
+            _trusted = None
+            _failed = None
 
         if jwt_ms:
-            try:
-                json_ms = unfurl(jwt_ms)
-            except JWSException as err:
-                logger.error('Could not unfurl jwt_ms due to {}'.format(err))
-                raise
+            if not isinstance(jwt_ms, ParsedJWS):
+                try:
+                    jwt_ms = ParsedJWS(jwt_ms)
+                except JWSException as err:
+                    logger.error(
+                        'Could not unfurl jwt_ms due to {}'.format(err))
+                    raise
+            json_ms = jwt_ms.payload
 
         if json_ms:
-            return self._unpack(json_ms, keyjar, cls, jwt_ms, liss)
+            if budget is None:
+                # One deadline for all the fetching that has to be done
+                budget = Budget(self.max_verifications, self.fetch_timeout)
+            return self._unpack(json_ms, keyjar, cls, jwt_ms, liss,
+                                budget=budget, skip=skip, context=context,
+                                trusted=_trusted, failed=_failed,
+                                parsed=parsed)
         else:
             raise AttributeError('Need one of json_ms or jwt_ms')
 
+    def _unpack_item(self, item, keyjar, cls, liss, evaluate):
+        """
+        Unpack, and possibly evaluate, one metadata statement. Errors that
+        stops the statement from being unpacked are stored in the returned
+        ParseInfo instance under the statement, or under '' if the statement
+        is not a signed JWT.
+        """
+        _key = item if isinstance(item, string_types) else ''
+        try:
+            if _key:
+                _pi = self.unpack_metadata_statement(
+                    jwt_ms=item, keyjar=keyjar, cls=cls, liss=liss)
+            else:
+                _pi = self.unpack_metadata_statement(
+                    json_ms=item, keyjar=keyjar, cls=cls, liss=liss)
+        except (JWSException, ParseError, MetadataStatementError) as err:
+            logger.error('Could not unpack metadata statement: {}'.format(err))
+            _pi = ParseInfo()
+            if self._keep_details():
+                _pi.input = item
+            _pi.error[_key] = err
+            return _pi
+
+        if evaluate and _pi.result:
+            try:
+                _pi.les = self.evaluate_metadata_statement(_pi.result)
+            except (ParseError, MetadataStatementError) as err:
+                logger.error(
+                    'Could not evaluate metadata statement: {}'.format(err))
+                _pi.error[_key] = err
+        return _pi
+
+    def unpack_many(self, statements, keyjar=None,
+                    cls=ClientMetadataStatement, liss=None, evaluate=False,
+                    workers=0):
+        """
+        Unpack and verify a number of compounded metadata statements.
+        The FO keys are set up once for the whole batch and intermediate
+        statements that have already been verified are picked up from the
+        cache of verified statements. If the keys of the JWKS bundle are
+        used, what is learned about trusted intermediates and statements
+        that could not be verified is shared by the whole batch.
+
+        :param statements: Iterable of metadata statements, as signed JWTs
+            or as JSON documents
+        :param keyjar: Keys that should be used to verify the signatures.
+            If not given the keys in the JWKS bundle are used.
+        :param cls: What type (Class) of metadata statement this is
+        :param liss: list of FO identifiers that matters. The rest will be
+            ignored
+        :param evaluate: If True the unpacked statements are also evaluated
+            and the result stored as ParseInfo.les
+        :param workers: Number of threads the work should be spread over.
+            0 means it is all done in the calling thread.
+        :return: Generator that yields one ParseInfo instance per statement,
+            in the same order as the statements came in.
+        """
+        # Every statement is unpacked using its own overlay on top of keyjar,
+        # or of the KeyJar the JWKS bundle keeps if none is given
+        if not workers:
+            for item in statements:
+                yield self._unpack_item(item, keyjar, cls, liss, evaluate)
+            return
+
+        _pool = ThreadPoolExecutor(max_workers=workers)
+        _pending = deque()
+        try:
+            for item in statements:
+                _pending.append(
+                    _pool.submit(self._unpack_item, item, keyjar, cls, liss,
+                                 evaluate))
+                # Don't read too far ahead
+                if len(_pending) >= 2 * workers:
+                    yield _pending.popleft().result()
+
+            while _pending:
+                yield _pending.popleft().result()
+        finally:
+            for f in _pending:
+                f.cancel()
+            _pool.shutdown(wait=False)
+
+    def prescan(self, json_ms, context='', parsed=None):
+        """
+        Go through a compounded metadata statement without verifying any
+        signatures and find the signed metadata statements that can not be
+        used. A signed metadata statement can not be used if it has expired,
+        if it is signed using an algorithm that is not allowed, if the claims
+        that are looked at here have the wrong types or if none
+        of the paths down from it ends in a statement issued by a FO in my
+        JWKS bundle and meant to be used in this context.
+        Metadata statements referenced by URI are not looked at.
+
+        :param json_ms: Metadata statement as a dictionary
+        :param context: In which context the metadata statement should be
+            used.
+        :param parsed: If given, a dictionary into which the signed
+            metadata statements are added as keys with
+            :py:class:`fedoidc.ParsedJWS` instances as values, so they don't
+            have to be parsed again when unpacked.
+        :return: Set of signed metadata statements that should not be
+            unpacked.
+        """
+        if self.jwks_bundle is not None:
+            # The merged KeyJar is cached by the bundle, listing the keys of
+            # the bundle itself might mean reading a directory.
+            _fos = set(self.jwks_bundle.as_keyjar().keys())
+        else:
+            _fos = None
+
+        _now = utc_time_sans_frac()
+        _usable = {}
+        # Each item on the stack is [signed statement, statement, depth,
+        # signed sub statements]
+        _stack = [[None, json_ms, 0, None]]
+        while _stack:
+            item = _stack[-1]
+            _jws, _ms, _depth, _subs = item
+            if _subs is None:
+                if 'metadata_statements' in _ms:
+                    _subs = list(_ms['metadata_statements'].values())
+                else:
+                    _subs = []
+
+                if _subs:
+                    if self.max_branches and len(_subs) > self.max_branches:
+                        raise LimitExceeded(
+                            'Too many branches: {} > {}'.format(
+                                len(_subs), self.max_branches))
+                    if self.max_depth and _depth + 1 > self.max_depth:
+                        raise LimitExceeded(
+                            'Metadata statements nested deeper then {}'.format(
+                                self.max_depth))
+
+                item[3] = _subs
+                _todo = []
+                for meta_s in _subs:
+                    if not isinstance(meta_s, string_types) or \
+                            meta_s in _usable:
+                        continue
+                    try:
+                        _pjws = ParsedJWS(meta_s)
+                    except JWSException as err:
+                        logger.info('Unusable metadata statement: {}'.format(
+                            err))
+                        _usable[meta_s] = False
+                        continue
+                    if parsed is not None:
+                        parsed[meta_s] = _pjws
+
+                    if _pjws.alg not in self.allowed_algs:
+                        logger.info('Signing algorithm not allowed: {}'.format(
+                            _pjws.alg))
+                        _usable[meta_s] = False
+                    elif not well_formed(_pjws.payload):
+                        logger.info('Malformed metadata statement')
+                        _usable[meta_s] = False
+                    elif 'exp' in _pjws.payload and \
+                            _pjws.payload['exp'] < _now:
+                        logger.info('Metadata statement has expired')
+                        _usable[meta_s] = False
+                    else:
+                        _todo.append([meta_s, _pjws.payload, _depth + 1, None])
+
+                if _todo:
+                    _stack.extend(_todo)
+                    continue
+
+            _stack.pop()
+            if _jws is None:  # The outermost, not signed
+                continue
+
+            if 'metadata_statement_uris' in _ms:
+                # Can't tell what is behind the URIs
+                _usable[_jws] = True
+            elif 'metadata_statements' in _ms:
+                _usable[_jws] = any([_usable.get(s, False) for s in _subs])
+            else:  # this is the innermost
+                _ok = True
+                if _fos is not None and _ms.get('iss') not in _fos:
+                    logger.info('Not issued by a FO I know: {}'.format(
+                        _ms.get('iss')))
+                    _ok = False
+                elif context and \
+                        _ms.get('federation_usage', context) != context:
+                    logger.info('Not meant to be used for {}'.format(context))
+                    _ok = False
+                _usable[_jws] = _ok
+
+        return set([s for s, ok in _usable.items() if not ok])
+
     def pack_metadata_statement(self, metadata, keyjar=None, iss=None, alg='',
                                 jwt_args=None, lifetime=-1, **kwargs):
         """
@@ -374,53 +1560,145 @@ class Operator(object):
         else:
             return _jwt.pack(cls_instance=_metadata, owner=owner)
 
-    def evaluate_metadata_statement(self, metadata, keyjar=None):
+    def evaluate_metadata_statement(self, metadata, keyjar=None, lazy=False):
         """
         Computes the resulting metadata statement from a compounded metadata
         statement.
         If something goes wrong during the evaluation an exception is raised
 
+        The result of flattening an intermediate metadata statement is
+        remembered, keyed by the digest of the statement, until the earliest
+        expiration time in the chain. A statement that appears more then
+        once in the compounded statement is only flattened once.
+
         :param metadata: The compounded metadata statement as a dictionary
+        :param lazy: If True the claims in the outermost statement are
+            evaluated when they are asked for, see
+            :py:meth:`fedoidc.operator.LessOrEqual.eval`.
         :return: A list of :py:class:`fedoidc.operator.LessOrEqual` 
             instances, one per FO.
         """
 
-        # start from the innermost metadata statement and work outwards
+        # start from the innermost metadata statement and work outwards.
+        # Each item on the stack is [statement, depth, sub statements,
+        # digest]. The result for each statement is kept in _les under its
+        # digest, the outermost statement has none.
+        _now = utc_time_sans_frac()
+        _les = {}
+        _stack = [[metadata, 0, None, '']]
+        while _stack:
+            item = _stack[-1]
+            _ms, _depth, _subs, _digest = item
+            if _subs is None:
+                if _digest in _les:  # Same as a statement already done
+                    _stack.pop()
+                    continue
 
-        res = dict([(k, v) for k, v in metadata.items() if k not in IgnoreKeys])
+                _subs = []
+                if 'metadata_statements' in _ms:
+                    for fo, ms in _ms['metadata_statements'].items():
+                        if isinstance(ms, string_types):
+                            ms = json.loads(ms)
+                        if isinstance(ms, Message):
+                            ms = ms.to_dict()
+                        _subs.append((ms, statement_digest(ms)))
+
+                    if self.max_branches and len(_subs) > self.max_branches:
+                        raise LimitExceeded(
+                            'Too many branches: {} > {}'.format(
+                                len(_subs), self.max_branches))
+                    if self.max_depth and _depth + 1 > self.max_depth:
+                        raise LimitExceeded(
+                            'Metadata statements nested deeper then {}'.format(
+                                self.max_depth))
+                item[2] = _subs
+                _todo = []
+                for ms, _dig in _subs:
+                    if _dig in _les:
+                        continue
+                    _cached = self.flattened.get(_dig)
+                    if _cached is not None:
+                        _les[_dig] = _cached
+                        continue
+                    _todo.append([ms, _depth + 1, None, _dig])
 
-        les = []
+                if _todo:
+                    _stack.extend(_todo)
+                    continue
 
-        if 'metadata_statements' in metadata:
-            for fo, ms in metadata['metadata_statements'].items():
-                if isinstance(ms, str):
-                    ms = json.loads(ms)
-                for _le in self.evaluate_metadata_statement(ms):
-                    if isinstance(ms, Message):
-                        le = LessOrEqual(sup=_le, **ms.to_dict())
-                    else:  # Must be a dict
+            _stack.pop()
+            res = dict([(k, v) for k, v in _ms.items() if k not in IgnoreKeys])
+            les = []
+            if 'metadata_statements' in _ms:
+                for ms, _dig in _subs:
+                    for _le in _les[_dig]:
                         le = LessOrEqual(sup=_le, **ms)
-
-                    if le.is_expired():
-                        logger.error(
-                            'This metadata statement has expired: {}'.format(ms)
-                        )
-                        logger.info('My time: {}'.format(utc_time_sans_frac()))
-                        continue
-                    le.eval(res)
-                    les.append(le)
-            return les
-        else:  # this is the innermost
-            try:
-                _iss = metadata['iss']
-            except:
-                le = LessOrEqual()
+                        if le.is_expired(_now):
+                            logger.error(
+                                'This metadata statement has expired: '
+                                '{}'.format(ms))
+                            logger.info(
+                                'My time: {}'.format(utc_time_sans_frac()))
+                            continue
+                        le.eval(res, lazy=lazy and _ms is metadata)
+                        les.append(le)
+            else:  # this is the innermost
+                try:
+                    _iss = _ms['iss']
+                except KeyError:
+                    le = LessOrEqual()
+                else:
+                    le = LessOrEqual(iss=_iss, exp=_ms['exp'])
                 le.eval(res)
+                les.append(le)
+            _les[_digest] = les
+
+            if _digest:
+                _exp = chain_exp(les)
+                if _exp:
+                    self.flattened.set(_digest, les, _exp)
+
+        return _les['']
+
+    def evaluate_many(self, superior, statements, signer=''):
+        """
+        Evaluate a number of subordinate metadata statements against the
+        same superior. Much cheaper than evaluating them one by one.
+
+        :param superior: The superior as a
+            :py:class:`fedoidc.operator.LessOrEqual` instance, for instance
+            one of the instances returned by
+            :py:meth:`evaluate_metadata_statement`.
+        :param statements: List of subordinate metadata statements as
+            dictionaries
+        :param signer: Who vouches for the subordinate statements
+        :return: A list with one item per statement. Either a
+            :py:class:`fedoidc.operator.LessOrEqual` instance or, if the
+            statement did not conform to the superior, a list of errors.
+        """
+        if superior.is_expired():
+            raise MetadataStatementError(
+                'Superior metadata statement has expired')
+
+        _ignore = frozenset(IgnoreKeys)
+        _origs = []
+        for ms in statements:
+            if _ignore.isdisjoint(ms):
+                _origs.append(ms)
             else:
-                le = LessOrEqual(iss=_iss, exp=metadata['exp'])
-                le.eval(res)
-            les.append(le)
-            return les
+                _origs.append(
+                    dict([(k, v) for k, v in ms.items() if k not in _ignore]))
+
+        res = []
+        for _le, _err in superior.policy().eval_many(_origs, signer):
+            if _err:
+                res.append(_err)
+            else:
+                le = LessOrEqual(iss=signer, sup=superior, exp=superior.exp)
+                le.le = _le
+                le.err = _err
+                res.append(le)
+        return res
 
     def correct_usage(self, metadata, federation_usage):
         """
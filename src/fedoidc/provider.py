@@ -19,6 +19,7 @@ from oic.oic.provider import STR
 from oic.utils.http_util import Created
 from oic.utils.http_util import Response
 from oic.utils.sanitize import sanitize
+from six import string_types
 
 from fedoidc.utils import replace_jwks_key_bundle
 
@@ -35,7 +36,28 @@ class Provider(provider.Provider):
             jwks_uri='', jwks_name='', baseurl=None, client_cert=None,
             federation_entity=None, fo_priority=None,
             response_metadata_statements=None, signer=None,
-            signed_jwks_uri=''):
+            signed_jwks_uri='', max_request_size=2 ** 18,
+            max_request_branches=20, max_jws_length=2 ** 16):
+        """
+        Most arguments are the same as for
+        :py:class:`oic.oic.provider.Provider`. The federation specific ones
+        are:
+
+        :param federation_entity: A
+            :py:class:`fedoidc.entity.FederationEntity` instance
+        :param fo_priority: List of FO IDs in order of preference
+        :param response_metadata_statements: Signed metadata statements to
+            add to responses
+        :param signer: A :py:class:`fedoidc.signing_service.Signer` instance
+        :param signed_jwks_uri: Where the signed JWKS can be found
+        :param max_request_size: Max size of a registration request.
+            0 means no limit.
+        :param max_request_branches: Max number of metadata statements
+            that may be included in, or referenced from, a registration
+            request. 0 means no limit.
+        :param max_jws_length: Max size of a signed metadata statement
+            included in a registration request. 0 means no limit.
+        """
         provider.Provider.__init__(
             self, name, sdb, cdb, authn_broker, userinfo, authz,
             client_authn, symkey, urlmap=urlmap,
@@ -50,6 +72,9 @@ class Provider(provider.Provider):
         self.signer = signer
         self.signed_jwks_uri = signed_jwks_uri
         self.federation = ''
+        self.max_request_size = max_request_size
+        self.max_request_branches = max_request_branches
+        self.max_jws_length = max_jws_length
 
     def get_signed_keys(self, uri, signing_keys):
         """
@@ -187,6 +212,31 @@ class Provider(provider.Provider):
         else:
             return False
 
+    def admission_error(self, request):
+        """
+        Cheap checks on a registration request that are done before any
+        signatures are looked at. Keeps requests that would be too costly
+        to process out.
+
+        :param request: The request as a
+            :py:class:`fedoidc.ClientMetadataStatement` instance
+        :return: A description of what is wrong or None if the request
+            can be processed.
+        """
+        _num = 0
+        for param in ['metadata_statements', 'metadata_statement_uris']:
+            if param in request:
+                _num += len(request[param])
+        if self.max_request_branches and _num > self.max_request_branches:
+            return 'Too many metadata statements'
+
+        if self.max_jws_length and 'metadata_statements' in request:
+            for _jws in request['metadata_statements'].values():
+                if isinstance(_jws, string_types) and \
+                        len(_jws) > self.max_jws_length:
+                    return 'Signed metadata statement too large'
+        return None
+
     def registration_endpoint(self, request, authn=None, **kwargs):
         """
         Registration endpoint. This is where a registration request should
@@ -203,6 +253,9 @@ class Provider(provider.Provider):
         if isinstance(request, dict):
             request = ClientMetadataStatement(**request)
         else:
+            if self.max_request_size and len(request) > self.max_request_size:
+                return error_response(error='invalid_request',
+                                      descr='Request too large')
             try:
                 request = ClientMetadataStatement().deserialize(request, "json")
             except ValueError:
@@ -213,6 +266,10 @@ class Provider(provider.Provider):
                                                            request.to_json(),
                                                            authn=None, **kwargs)
 
+        _err = self.admission_error(request)
+        if _err:
+            return error_response(error='invalid_request', descr=_err)
+
         try:
             request.verify()
         except Exception as err:
@@ -221,8 +278,9 @@ class Provider(provider.Provider):
         logger.info(
             "registration_request:{}".format(sanitize(request.to_dict())))
 
-        les = self.federation_entity.get_metadata_statement(request,
-                                                            'registration')
+        les = self.federation_entity.get_metadata_statement(
+            request, context='registration', lazy=True,
+            priority=self.fo_priority, first_valid=True)
 
         if les:
             ms = self.federation_entity.pick_by_priority(les)
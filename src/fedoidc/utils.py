@@ -1,6 +1,7 @@
 import json
 
 from fedoidc import MetadataStatement
+from fedoidc import verification_keys
 from fedoidc.bundle import jwks_to_keyjar
 from jwkest import as_unicode
 from jwkest.jws import JWS, alg2keytype
@@ -54,12 +55,8 @@ def verify_self_signed_jwks(sjwt):
 
     _kj = jwks_to_keyjar(_jwks, iss)
 
-    try:
-        _kid = _jws.jwt.headers['kid']
-    except KeyError:
-        _keys = _kj.get_signing_key(owner=iss)
-    else:
-        _keys = _kj.get_signing_key(owner=iss, kid=_kid)
+    _keys = verification_keys(_kj, iss, _jws.jwt.headers.get('kid', ''),
+                              _jws.jwt.headers.get('alg', ''))
 
     _ver = _jws.verify_compact(sjwt, _keys)
     return {'jwks': _ver['jwks'], 'iss': iss}
@@ -106,12 +103,8 @@ def verify_request_signed_by_signing_keys(smsreq):
 
     _kj = jwks_to_keyjar(_jwks, iss)
 
-    try:
-        _kid = _jws.jwt.headers['kid']
-    except KeyError:
-        _keys = _kj.get_signing_key(owner=iss)
-    else:
-        _keys = _kj.get_signing_key(owner=iss, kid=_kid)
+    _keys = verification_keys(_kj, iss, _jws.jwt.headers.get('kid', ''),
+                              _jws.jwt.headers.get('alg', ''))
 
     _ver = _jws.verify_compact(smsreq, _keys)
     # remove the JWT specific claims
@@ -1,20 +1,32 @@
+import copy
 import os
+from concurrent.futures import ProcessPoolExecutor
 
+import pytest
 from fedoidc import ClientMetadataStatement
+from fedoidc import KeyJar as FedKeyJar
+from fedoidc import KeyJarOverlay
 from fedoidc import MetadataStatement
+from fedoidc import ParsedJWS
 from fedoidc import ProviderConfigurationResponse
 from fedoidc import is_lesser
 from fedoidc import unfurl
+from fedoidc import verification_keys
 from fedoidc.bundle import JWKSBundle
 from fedoidc.bundle import verify_signed_bundle
+from fedoidc.cache import ExpiringCache
+from fedoidc.operator import LessOrEqual
+from fedoidc.operator import LimitExceeded
 from fedoidc.operator import Operator
 from fedoidc.operator import le_dict
+from jwkest import BadSignature
 from jwkest import jws
 
 from oic.oauth2.message import Message
 from oic.oauth2.message import MissingSigningKey
 from oic.utils.keyio import KeyJar
 from oic.utils.keyio import build_keyjar
+from oic.utils.time_util import utc_time_sans_frac
 
 BASE_PATH = os.path.abspath(
     os.path.join(os.path.dirname(__file__), "data/keys"))
@@ -179,6 +191,167 @@ def test_pack_and_unpack_ms_lev2():
     assert ri.result
 
 
+def test_unpack_verified_cache():
+    cms_org = ClientMetadataStatement(
+        signing_keys=KEYS['org']['jwks'],
+        contacts=['info@example.com']
+    )
+
+    #  signed by FO
+    ms_org = FOP.pack_metadata_statement(cms_org, alg='RS256', scope=['openid'])
+
+    cms_rp = ClientMetadataStatement(
+        signing_keys=KEYS['admin']['jwks'],
+        redirect_uris=['https://rp.example.com/auth_cb']
+    )
+
+    #  signed by org
+    ms_rp = ORGOP.pack_metadata_statement(
+        cms_rp, alg='RS256', metadata_statements=Message(**{FOP.iss: ms_org}))
+
+    receiver = fo_member(FOP)
+    ri = receiver.unpack_metadata_statement(jwt_ms=ms_rp)
+    assert ri.result
+    # Both the FO signed and the org signed statement
+    assert len(receiver.verified) == 2
+
+    ri2 = receiver.unpack_metadata_statement(jwt_ms=ms_rp)
+    assert ri2.result.to_dict() == ri.result.to_dict()
+    assert len(receiver.verified) == 2
+    assert ri2.result.jwt == ms_rp
+    assert ri2.result.jws_header == ri.result.jws_header
+
+    # Someone that doesn't trust the FO must not use the cached verdict
+    other = fo_member(FO1P)
+    other.verified = receiver.verified
+    ri3 = other.unpack_metadata_statement(jwt_ms=ms_rp)
+    assert ri3.result is None
+
+
+def test_unpack_failed_cache_poisoning():
+    ms_fo = FOP.pack_metadata_statement(
+        ClientMetadataStatement(signing_keys=KEYS['org']['jwks']),
+        alg='RS256')
+    # The organisations real statement
+    ms_org = ORGOP.pack_metadata_statement(
+        ClientMetadataStatement(contacts=['info@example.com']), alg='RS256',
+        metadata_statements=Message(**{FOP.iss: ms_fo}))
+
+    # Another member gets its own key vouched for by the FO, using the kid
+    # of the organisations key
+    _jwks = copy.deepcopy(KEYS['admin']['jwks'])
+    _jwks['keys'] = [k for k in _jwks['keys'] if k['kty'] == 'RSA']
+    _jwks['keys'][0]['kid'] = KEYS['org']['kidd']['sig']['RSA']
+    ms_fake = FOP.pack_metadata_statement(
+        ClientMetadataStatement(signing_keys=_jwks), alg='RS256')
+    # and claims to be the organisation
+    _fake_org = Operator(keyjar=KEYS['admin']['keyjar'], iss=ISSUER['org'])
+    ms_claim = _fake_org.pack_metadata_statement(
+        ClientMetadataStatement(contacts=['evil@example.com']), alg='RS256',
+        metadata_statements=Message(**{FOP.iss: ms_fake}))
+
+    receiver = fo_member(FOP)
+    req = MetadataStatement(metadata_statements=Message(
+        **{'https://evil.example.org': ms_claim, FOP.iss: ms_org}))
+    ri = receiver.unpack_metadata_statement(json_ms=req)
+    # The real statement was verified using the wrong key
+    assert not ri.parsed_statement
+
+    # Someone else sending the real statement is not affected
+    req = MetadataStatement(metadata_statements=Message(
+        **{FOP.iss: ms_org}))
+    ri = receiver.unpack_metadata_statement(json_ms=req)
+    assert len(ri.parsed_statement) == 1
+
+
+def test_unpack_trusted_intermediates():
+    cms_org = ClientMetadataStatement(
+        signing_keys=KEYS['org']['jwks'],
+        contacts=['info@example.com']
+    )
+    ms_org = FOP.pack_metadata_statement(cms_org, alg='RS256', scope=['openid'])
+
+    cms_inter = ClientMetadataStatement(
+        signing_keys=KEYS['inter']['jwks'],
+        tos_uri=['https://inter.example.com/tos.html']
+    )
+    ms_inter = ORGOP.pack_metadata_statement(
+        cms_inter, alg='RS256',
+        metadata_statements=Message(**{FOP.iss: ms_org}))
+
+    ms_rp = {}
+    for rp in ['https://rp.example.com', 'https://rp.example.org']:
+        ms_rp[rp] = INTEROP.pack_metadata_statement(
+            ClientMetadataStatement(redirect_uris=[rp + '/auth_cb']),
+            alg='RS256', metadata_statements=Message(**{FOP.iss: ms_inter}))
+
+    receiver = fo_member(FOP)
+    receiver.verified = ExpiringCache(0)
+    ri = receiver.unpack_metadata_statement(
+        jwt_ms=ms_rp['https://rp.example.com'])
+    assert ri.result
+    _kb = receiver.trusted.key_bundle(FOP.iss, ISSUER['inter'])
+    assert _kb
+    assert receiver.trusted.key_bundle(FOP.iss, ISSUER['org'])
+
+    # Only the statement signed by the intermediate has to be verified
+    receiver.max_verifications = 1
+    ri = receiver.unpack_metadata_statement(
+        jwt_ms=ms_rp['https://rp.example.org'])
+    assert ri.result
+    les = receiver.evaluate_metadata_statement(ri.result)
+    assert len(les) == 1
+    assert les[0].fo == FOP.iss
+    assert les[0]['redirect_uris'] == ['https://rp.example.org/auth_cb']
+    # Same result as walking the whole chain
+    _ri = fo_member(FOP).unpack_metadata_statement(
+        jwt_ms=ms_rp['https://rp.example.org'])
+    assert ri.result.to_dict() == _ri.result.to_dict()
+
+    # New FO keys, start from the FO again
+    receiver.jwks_bundle[FO1P.iss] = FO1P.signing_keys_as_jwks()
+    with pytest.raises(LimitExceeded):
+        receiver.unpack_metadata_statement(
+            jwt_ms=ms_rp['https://rp.example.org'])
+
+
+def test_unpack_trusted_intermediates_usage():
+    cms_org = ClientMetadataStatement(
+        signing_keys=KEYS['org']['jwks'],
+        contacts=['info@example.com']
+    )
+    ms_org = FOP.pack_metadata_statement(cms_org, alg='RS256',
+                                         federation_usage='discovery')
+
+    cms_inter = ClientMetadataStatement(
+        signing_keys=KEYS['inter']['jwks'],
+        tos_uri=['https://inter.example.com/tos.html']
+    )
+    ms_inter = ORGOP.pack_metadata_statement(
+        cms_inter, alg='RS256',
+        metadata_statements=Message(**{FOP.iss: ms_org}))
+
+    ms_rp = {}
+    for rp in ['https://rp.example.com', 'https://rp.example.org']:
+        ms_rp[rp] = INTEROP.pack_metadata_statement(
+            ClientMetadataStatement(redirect_uris=[rp + '/auth_cb']),
+            alg='RS256', metadata_statements=Message(**{FOP.iss: ms_inter}))
+
+    receiver = fo_member(FOP)
+    ri = receiver.unpack_metadata_statement(
+        jwt_ms=ms_rp['https://rp.example.com'], context='discovery')
+    assert ri.result
+    assert receiver.trusted.key_bundle(FOP.iss, ISSUER['inter'])
+
+    # What was vouched for in one context can not be used in another
+    ri = receiver.unpack_metadata_statement(
+        jwt_ms=ms_rp['https://rp.example.org'], context='registration')
+    assert not ri.result
+    ri = receiver.unpack_metadata_statement(
+        jwt_ms=ms_rp['https://rp.example.org'], context='discovery')
+    assert ri.result
+
+
 def test_multiple_fo_one_working():
     cms_org = ClientMetadataStatement(
         signing_keys=KEYS['org']['jwks'],
@@ -244,6 +417,129 @@ def test_multiple_fo_all_working():
     assert set(_iss) == {ISSUER['fo'], ISSUER['fo1']}
 
 
+def test_multiple_fo_process_pool():
+    cms_org = ClientMetadataStatement(
+        signing_keys=KEYS['org']['jwks'],
+        contacts=['info@example.com']
+    )
+
+    ms_org1 = FOP.pack_metadata_statement(cms_org, alg='RS256',
+                                          scope=['openid'])
+    ms_org2 = FO1P.pack_metadata_statement(cms_org, alg='RS256',
+                                           scope=['openid', 'address'])
+
+    cms_rp = ClientMetadataStatement(
+        signing_keys=KEYS['admin']['jwks'],
+        redirect_uris=['https://rp.example.com/auth_cb']
+    )
+
+    ms_rp = ORGOP.pack_metadata_statement(
+        cms_rp, alg='RS256', metadata_statements=Message(**{FOP.iss: ms_org1,
+                                                            FO1P.iss: ms_org2}))
+
+    receiver = fo_member(FOP, FO1P)
+    serial = receiver.unpack_metadata_statement(jwt_ms=ms_rp)
+
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        receiver = fo_member(FOP, FO1P)
+        receiver.process_pool = pool
+        ri = receiver.unpack_metadata_statement(jwt_ms=ms_rp)
+
+    assert len(ri.parsed_statement) == 2
+    assert ri.result.to_dict() == serial.result.to_dict()
+
+    res = receiver.evaluate_metadata_statement(ri.result)
+    assert set([r.fo for r in res]) == {ISSUER['fo'], ISSUER['fo1']}
+
+
+def test_verification_key_index():
+    kj = FedKeyJar()
+    kj.import_jwks(KEYS['fo']['jwks'], ISSUER['fo'])
+    kj.import_jwks(KEYS['fo1']['jwks'], ISSUER['fo'])
+
+    _rsa = [k for k in kj.get_verify_key(owner=ISSUER['fo'], key_type='RSA')]
+    assert len(_rsa) == 2
+    _kid = _rsa[1].kid
+
+    keys = kj.verification_keys(ISSUER['fo'], _kid, 'RS256')
+    assert keys == [_rsa[1]]
+    assert kj.index[ISSUER['fo']][(_kid, 'RS256')] == keys
+    # no kid, all keys of the right type
+    assert len(kj.verification_keys(ISSUER['fo'], '', 'ES256')) == 2
+    # wrong type
+    assert kj.verification_keys(ISSUER['fo'], _kid, 'ES256') == []
+    # trailing slash
+    assert kj.verification_keys(ISSUER['fo'] + '/', _kid, 'RS256') == keys
+
+    # importing keys drops the index for that owner
+    kj.import_jwks(KEYS['org']['jwks'], ISSUER['fo'])
+    assert ISSUER['fo'] not in kj.index
+    assert len(kj.verification_keys(ISSUER['fo'], '', 'RS256')) == 3
+
+    # Plain KeyJar
+    assert verification_keys(KEYS['fo']['keyjar'], '', _rsa[0].kid,
+                             'RS256') == [_rsa[0]]
+
+
+def test_keyjar_overlay():
+    base = FedKeyJar()
+    base.import_jwks(KEYS['fo']['jwks'], ISSUER['fo'])
+    _kid = KEYS['fo']['kidd']['sig']['RSA']
+    keys = base.verification_keys(ISSUER['fo'], _kid, 'RS256')
+
+    kj = base.overlay()
+    assert isinstance(kj, KeyJarOverlay)
+    # reads fall through
+    assert kj.verification_keys(ISSUER['fo'], _kid, 'RS256') == keys
+    assert set(kj.keys()) == {ISSUER['fo']}
+    # and lookups for unchanged owners fill in the index of the base
+    kj.verification_keys(ISSUER['fo'], '', 'RS256')
+    assert ('', 'RS256') in base.index[ISSUER['fo']]
+
+    # writes stay in the overlay
+    kj.import_jwks(KEYS['org']['jwks'], ISSUER['org'])
+    kj.import_jwks(KEYS['fo1']['jwks'], ISSUER['fo'])
+    assert set(kj.keys()) == {ISSUER['fo'], ISSUER['org']}
+    assert len(kj.verification_keys(ISSUER['fo'], '', 'RS256')) == 2
+    assert set(base.keys()) == {ISSUER['fo']}
+    assert len(base.get_issuer_keys(ISSUER['fo'])) == 2
+    assert base.verification_keys(ISSUER['fo'], '', 'RS256') == keys
+    assert base.index[ISSUER['fo']][('', 'RS256')] == keys
+
+    del kj.issuer_keys[ISSUER['fo']]
+    assert ISSUER['fo'] not in kj
+    assert set(kj.keys()) == {ISSUER['org']}
+    assert ISSUER['fo'] in base
+
+    # On top of a plain KeyJar
+    kj = KeyJarOverlay(KEYS['fo']['keyjar'])
+    kj.import_jwks(KEYS['org']['jwks'], ISSUER['org'])
+    assert set(kj.keys()) == {'', ISSUER['org']}
+    assert set(KEYS['fo']['keyjar'].keys()) == {''}
+
+
+def test_parsed_jws():
+    cms = ClientMetadataStatement(contacts=['info@example.com'])
+    _jwt = FOP.pack_metadata_statement(cms, alg='RS256')
+
+    pjws = ParsedJWS(_jwt)
+    assert pjws.alg == 'RS256'
+    assert pjws.payload == unfurl(_jwt)
+    assert pjws.payload['iss'] == ISSUER['fo']
+
+    _keys = FOP.keyjar.get_verify_key(owner='', key_type='RSA')
+    assert pjws.verify(_keys) in _keys
+
+    # Tamper with the signature
+    _part = _jwt.split('.')
+    _part[2] = _part[2][:-4] + ('AAAA' if _part[2][-4:] != 'AAAA' else 'BBBB')
+    with pytest.raises(BadSignature):
+        ParsedJWS('.'.join(_part)).verify(_keys)
+
+    with pytest.raises(jws.JWSException):
+        ParsedJWS('foo.bar')
+
+
 def test_is_lesser_strings():
     assert is_lesser('foo', 'foo')
     assert is_lesser('foo', 'fox') is False
@@ -260,6 +556,149 @@ def test_is_lesser_list():
     assert is_lesser(['fee', 'fum'], ['fee']) is False
 
 
+def test_is_lesser_list_mixed():
+    assert is_lesser([1, 3], [4])
+    assert is_lesser([1, 5], [4]) is False
+    assert is_lesser([0.5], [1.0])
+    assert is_lesser([1], [1.0]) is False
+    assert is_lesser([True], [1]) is False
+    assert is_lesser([1], [True]) is False
+    assert is_lesser([None], [None]) is False
+    assert is_lesser(['foo', 1], [2, 'foo'])
+    assert is_lesser([['a'], {'b': 'c'}], [{'b': 'c', 'd': 'e'}, ['a', 'x']])
+    assert is_lesser([['a', 'y']], [['a', 'x']]) is False
+    assert is_lesser([], [])
+    assert is_lesser(['foo'], []) is False
+
+
+def test_is_lesser_dict():
+    assert is_lesser({'a': ['x']}, {'a': ['x', 'y'], 'b': 1})
+    assert is_lesser({'a': ['x'], 'c': 1}, {'a': ['x', 'y']}) is False
+    assert is_lesser({'a': 2}, {'a': 1}) is False
+    assert is_lesser({}, {'a': 1})
+
+
+def test_less_or_equal_policy():
+    sup = LessOrEqual(iss='https://fo.example.org')
+    sup.eval({'scope': ['openid', 'email'], 'contacts': ['a@example.org'],
+              'kid': 'abc'})
+    _policy = sup.policy()
+    assert _policy.names == {'scope', 'contacts'}
+
+    le = LessOrEqual(iss='https://org.example.org', sup=sup)
+    le.eval({'scope': ['openid'], 'tos_uri': 'https://org.example.org/tos'})
+    assert le.le == {'scope': ['openid', 'email'],
+                     'contacts': ['a@example.org'],
+                     'tos_uri': 'https://org.example.org/tos'}
+    assert le.err == []
+
+    le = LessOrEqual(iss='https://org.example.org', sup=sup)
+    le.eval({'scope': ['openid', 'phone']})
+    assert le.le['scope'] == ['openid', 'phone']
+    assert le.err == [{'claim': 'scope', 'policy': ['openid', 'phone'],
+                       'err': ['openid', 'email'],
+                       'signer': 'https://org.example.org'}]
+
+    # compiled once
+    assert sup.policy() is _policy
+    sup['scope'] = ['openid']
+    assert sup.policy() is not _policy
+
+
+def test_less_or_equal_claim_views():
+    sup = LessOrEqual(iss='https://fo.example.org')
+    sup.eval({'scope': ['openid', 'email']})
+    le = LessOrEqual(iss='https://org.example.org', sup=sup)
+    le.eval({'scope': ['openid'], 'tos_uri': 'https://org.example.org/tos'})
+
+    _upc = le.unprotected_and_protected_claims()
+    assert _upc == {'tos_uri': 'https://org.example.org/tos'}
+    # computed once, handed out as read-only views
+    with pytest.raises(TypeError):
+        _upc['tos_uri'] = 'https://example.com/tos'
+    with pytest.raises(TypeError):
+        le.protected_claims()['scope'] = ['openid', 'phone']
+    assert le.protected_claims() == sup.le
+    le['policy_uri'] = 'https://org.example.org/policy'
+    assert le.unprotected_and_protected_claims() == {
+        'tos_uri': 'https://org.example.org/tos',
+        'policy_uri': 'https://org.example.org/policy'}
+
+    with pytest.raises(AttributeError):
+        le.extra = 1
+
+
+def test_less_or_equal_lazy():
+    sup = LessOrEqual(iss='https://fo.example.org')
+    sup.eval({'scope': ['openid', 'email'], 'contacts': ['a@example.org'],
+              'kid': 'abc'})
+    orig = {'scope': ['openid', 'phone'], 'tos_uri': 'https://org.example.org',
+            'kid': 'def'}
+
+    eager = LessOrEqual(iss='https://org.example.org', sup=sup)
+    eager.eval(orig)
+
+    le = LessOrEqual(iss='https://org.example.org', sup=sup)
+    le.eval(orig, lazy=True)
+    assert le.err == []
+    assert le['tos_uri'] == 'https://org.example.org'
+    assert le['contacts'] == ['a@example.org']
+    assert le.err == []
+    assert 'scope' in le
+    assert 'kid' not in le
+    with pytest.raises(KeyError):
+        le['kid']
+    assert le['scope'] == ['openid', 'phone']
+    assert len(le.err) == 1
+
+    # full evaluation
+    assert le.le == eager.le
+    assert le.err == eager.err
+
+
+def test_less_or_equal_min_exp():
+    now = utc_time_sans_frac()
+    fo = LessOrEqual(iss='https://fo.example.org', exp=now + 100)
+    org = LessOrEqual(iss='https://org.example.org', sup=fo, exp=now + 10)
+    rp = LessOrEqual(iss='https://rp.example.org', sup=org, exp=now + 50)
+    assert fo.min_exp == now + 100
+    assert rp.min_exp == now + 10
+    assert rp.is_expired() is False
+    assert rp.is_expired(now + 20)
+    assert fo.is_expired(now + 20) is False
+
+
+def test_evaluate_many():
+    sup = LessOrEqual(iss='https://fo.example.org',
+                      exp=utc_time_sans_frac() + 60)
+    sup.eval({'scope': ['openid', 'email'], 'contacts': ['a@example.org'],
+              'response_types': ['code']})
+
+    statements = [
+        {'scope': ['openid'], 'redirect_uris': ['https://rp.example.org/cb']},
+        {'scope': ['openid', 'phone']},
+        {'scope': ['openid'], 'contacts': ['a@example.org'], 'exp': 10},
+        {'scope': 'openid', 'response_types': [['code']]},
+        {}
+    ]
+    res = Operator().evaluate_many(sup, statements,
+                                   signer='https://org.example.org')
+    assert len(res) == 5
+
+    for ms, r in zip(statements, res):
+        le = LessOrEqual(iss='https://org.example.org', sup=sup)
+        le.eval(dict([(k, v) for k, v in ms.items() if k != 'exp']))
+        if le.err:
+            assert r == le.err
+        else:
+            assert isinstance(r, LessOrEqual)
+            assert r.le == le.le
+            assert r.protected_claims() == sup.le
+
+    assert [isinstance(r, list) for r in res] == [False, True, False, True,
+                                                  False]
+
+
 def test_evaluate_metadata_statement_1():
     cms_org = ClientMetadataStatement(
         signing_keys=ORGOP.keyjar.export_jwks(), contacts=['info@example.com'])
@@ -449,6 +888,71 @@ def test_evaluate_metadata_statement_4():
     assert res[ISSUER['fo']]['scope'] == ['openid', 'email', 'phone']
 
 
+def test_evaluate_flattened_cache():
+    cms_org = ClientMetadataStatement(
+        signing_keys=KEYS['org']['jwks'],
+        contacts=['info@example.com']
+    )
+
+    #  signed by FO
+    ms_org = FOP.pack_metadata_statement(cms_org, alg='RS256',
+                                         scope=['openid', 'email', 'phone'])
+
+    cms_inter = ClientMetadataStatement(
+        signing_keys=KEYS['inter']['jwks'],
+        tos_uri=['https://inter.example.com/tos.html']
+    )
+
+    #  signed by org
+    ms_inter = ORGOP.pack_metadata_statement(
+        cms_inter, alg='RS256',
+        metadata_statements=Message(**{FOP.iss: ms_org}))
+
+    receiver = fo_member(FOP)
+    res = []
+    for scope in [['openid'], ['openid', 'email']]:
+        cms_rp = ClientMetadataStatement(
+            signing_keys=KEYS['admin']['jwks'],
+            redirect_uris=['https://rp.example.com/auth_cb'], scope=scope)
+
+        #  signed by intermediate
+        ms_rp = INTEROP.pack_metadata_statement(
+            cms_rp, alg='RS256',
+            metadata_statements=Message(**{FOP.iss: ms_inter}))
+
+        ri = receiver.unpack_metadata_statement(jwt_ms=ms_rp)
+        res.append(receiver.evaluate_metadata_statement(ri.result))
+
+    # inter and org
+    assert len(receiver.flattened) == 2
+    assert res[0][0].sup is res[1][0].sup
+    assert res[0][0]['scope'] == ['openid', 'email', 'phone']
+    assert res[1][0]['scope'] == ['openid', 'email', 'phone']
+    assert res[0][0].unprotected_and_protected_claims() == {
+        'redirect_uris': ['https://rp.example.com/auth_cb']}
+
+
+def test_evaluate_shared_statement():
+    _exp = utc_time_sans_frac() + 3600
+    ms_fo = {'iss': ISSUER['fo'], 'exp': _exp, 'scope': ['openid', 'email']}
+    ms_org = {'iss': ISSUER['org'], 'exp': _exp, 'scope': ['openid'],
+              'metadata_statements': {ISSUER['fo']: ms_fo}}
+    ms_inter = {'iss': ISSUER['inter'], 'exp': _exp, 'scope': ['email'],
+                'metadata_statements': {ISSUER['fo']: ms_fo}}
+    req = {'redirect_uris': ['https://rp.example.com/auth_cb'],
+           'metadata_statements': {ISSUER['org']: ms_org,
+                                   ISSUER['inter']: ms_inter}}
+
+    op = Operator(flatten_cache_size=0)
+    les = op.evaluate_metadata_statement(req)
+    assert len(les) == 2
+    # The FO statement is only flattened once
+    assert les[0].sup.sup is not None
+    assert les[0].sup.sup is les[1].sup.sup
+    assert set([le.iss for le in les]) == {ISSUER['org'], ISSUER['inter']}
+    assert les[0].fo == ISSUER['fo']
+
+
 def test_unpack_discovery_info():
     resp = ProviderConfigurationResponse()
 
@@ -1,3 +1,9 @@
+import os
+import shutil
+from urllib.parse import quote_plus
+from urllib.parse import unquote_plus
+
+from fedoidc.bundle import FSJWKSBundle
 from fedoidc.bundle import JWKSBundle
 
 from oic.utils.keyio import build_keyjar
@@ -95,3 +101,62 @@ def test_sign_verify():
 
     for iss, kj in bundle.items():
         assert bundle2[iss] == kj
+
+
+def test_as_keyjar_cached():
+    bundle = JWKSBundle(ISS, SIGN_KEYS)
+    bundle['https://www.swamid.se'] = KEYJAR['https://www.swamid.se']
+    bundle['https://www.sunet.se'] = KEYJAR['https://www.sunet.se']
+
+    kj = bundle.as_keyjar()
+    _merged = bundle._keyjar
+    assert set(kj.keys()) == {'https://www.swamid.se', 'https://www.sunet.se'}
+
+    # Changes to the returned keyjar does not leak into the bundle
+    kj.import_jwks(KEYJAR['https://www.feide.no'].export_jwks(),
+                   'https://www.swamid.se')
+    kj2 = bundle.as_keyjar()
+    assert bundle._keyjar is _merged
+    assert len(kj2.issuer_keys['https://www.swamid.se']) == 1
+
+    # Key lookups are remembered by the cached keyjar
+    kj2.verification_keys('https://www.sunet.se', '', 'RS256')
+    assert ('', 'RS256') in _merged.index['https://www.sunet.se']
+    assert 'https://www.swamid.se' not in _merged.index
+    kj.verification_keys('https://www.swamid.se', '', 'RS256')
+    assert 'https://www.swamid.se' not in _merged.index
+
+    bundle['https://www.feide.no'] = KEYJAR['https://www.feide.no']
+    kj3 = bundle.as_keyjar()
+    assert bundle._keyjar is not _merged
+    assert 'https://www.feide.no' in kj3
+
+    del bundle['https://www.sunet.se']
+    assert 'https://www.sunet.se' not in bundle.as_keyjar()
+
+
+def test_fs_as_keyjar_disc_change():
+    if os.path.isdir('fo_jwks'):
+        shutil.rmtree('fo_jwks')
+
+    bundle = FSJWKSBundle(ISS, SIGN_KEYS, 'fo_jwks', sync_interval=0,
+                          key_conv={'to': quote_plus, 'from': unquote_plus})
+    bundle['https://www.swamid.se'] = KEYJAR['https://www.swamid.se']
+    kj = bundle.as_keyjar()
+    assert set(kj.keys()) == {'https://www.swamid.se'}
+    _merged = bundle._keyjar
+    bundle.as_keyjar()
+    assert bundle._keyjar is _merged
+
+    # someone else adds a file
+    other = FSJWKSBundle(ISS, SIGN_KEYS, 'fo_jwks',
+                         key_conv={'to': quote_plus, 'from': unquote_plus})
+    other['https://www.feide.no'] = KEYJAR['https://www.feide.no']
+
+    kj = bundle.as_keyjar()
+    assert set(kj.keys()) == {'https://www.swamid.se', 'https://www.feide.no'}
+
+    # and removes one
+    os.unlink(os.path.join('fo_jwks', quote_plus('https://www.swamid.se')))
+    kj = bundle.as_keyjar()
+    assert set(kj.keys()) == {'https://www.feide.no'}
@@ -1,4 +1,5 @@
 import json
+import logging
 import os
 import shutil
 import time
@@ -6,16 +7,24 @@ from urllib.parse import quote_plus
 from urllib.parse import unquote_plus
 from urllib.parse import urlparse
 
+import pytest
+
+from fedoidc import KeyJar
 from fedoidc import MetadataStatement
 from fedoidc import test_utils
 from fedoidc.bundle import FSJWKSBundle
+from fedoidc.bundle import JWKSBundle
+from fedoidc.operator import Budget
 from fedoidc.operator import FederationOperator
+from fedoidc.operator import LimitExceeded
 from fedoidc.operator import Operator
+from fedoidc.operator import ParseError
 from fedoidc.test_utils import MetaDataStore
 from jwkest import as_unicode
 from jwkest.jws import factory
 
 from oic.utils.keyio import build_keyjar
+from oic.utils.time_util import utc_time_sans_frac
 
 KEYDEFS = [
     {"type": "RSA", "key": '', "use": ["sig"]},
@@ -91,6 +100,16 @@ class MockHTTPClient():
         return rsp
 
 
+class SlowHTTPClient(MockHTTPClient):
+    def __init__(self, mds, delay):
+        MockHTTPClient.__init__(self, mds)
+        self.delay = delay
+
+    def http_request(self, url):
+        time.sleep(self.delay)
+        return MockHTTPClient.http_request(self, url)
+
+
 def test_key_rotation():
     _keyjar = build_keyjar(KEYDEFS)[1]
     fo = FederationOperator(iss='https://example.com/op', keyjar=_keyjar,
@@ -168,3 +187,292 @@ def test_unpack_metadata_statement_uri():
     assert set([l.fo for l in loel]) == {'https://swamid.sunet.se',
                                          'https://edugain.com',
                                          'https://www.feide.no'}
+
+
+def test_fetch_parallel():
+    mds = {'a': 'A', 'b': 'B', 'c': 'C'}
+    op = Operator(httpcli=SlowHTTPClient(mds, 0.5))
+    uris = dict([(k, 'https://localhost/{}'.format(k)) for k in mds.keys()])
+    _start = time.time()
+    res = dict([(url, rsp.text) for url, rsp in op._fetch(uris, Budget())])
+    assert time.time() - _start < 1.2
+    assert res == {'https://localhost/a': 'A', 'https://localhost/b': 'B',
+                   'https://localhost/c': 'C'}
+
+
+def test_fetch_timeout():
+    mds = {'a': 'A', 'b': 'B'}
+    op = Operator(httpcli=SlowHTTPClient(mds, 2), fetch_timeout=0.5)
+    uris = dict([(k, 'https://localhost/{}'.format(k)) for k in mds.keys()])
+    _start = time.time()
+    with pytest.raises(ParseError):
+        list(op._fetch(uris, Budget(timeout=0.5)))
+    assert time.time() - _start < 1.5
+
+
+def test_fetch_timeout_nested():
+    _keyjar = build_keyjar(KEYDEFS)[1]
+    fo = Operator(keyjar=_keyjar, iss=FO['swamid'])
+    mds = {'leaf': fo.pack_metadata_statement(
+        MetadataStatement(contacts=['a@b.se']))}
+    mds['mid'] = fo.pack_metadata_statement(MetadataStatement(
+        metadata_statement_uris={FO['swamid']: 'https://localhost/leaf'}))
+    sms = fo.pack_metadata_statement(MetadataStatement(
+        metadata_statement_uris={FO['swamid']: 'https://localhost/mid'}))
+    kj = KeyJar()
+    kj.import_jwks(_keyjar.export_jwks(), FO['swamid'])
+
+    # Each fetch is within the timeout but not all of them together
+    op = Operator(httpcli=SlowHTTPClient(mds, 0.4), fetch_timeout=0.6,
+                  uri_cache_size=0)
+    with pytest.raises(ParseError):
+        op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+
+    op = Operator(httpcli=SlowHTTPClient(mds, 0.4), fetch_timeout=2,
+                  uri_cache_size=0)
+    res = op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+    assert res.result
+
+
+def _nested_statement(depth, branches=1):
+    """
+    Build a compounded metadata statement, all parts signed by the same FO.
+    """
+    _keyjar = build_keyjar(KEYDEFS)[1]
+    op = Operator(keyjar=_keyjar, iss=FO['swamid'])
+    sms = op.pack_metadata_statement(MetadataStatement(contacts=['a@b.se']))
+    for i in range(depth):
+        _ms = dict([('{}/{}'.format(FO['swamid'], n), sms)
+                    for n in range(branches)])
+        sms = op.pack_metadata_statement(
+            MetadataStatement(metadata_statements=_ms))
+
+    kj = KeyJar()
+    kj.import_jwks(_keyjar.export_jwks(), FO['swamid'])
+    return sms, kj
+
+
+def test_unpack_max_depth():
+    sms, kj = _nested_statement(4)
+    op = Operator(max_depth=3)
+    with pytest.raises(LimitExceeded):
+        op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+
+    op = Operator(max_depth=4)
+    res = op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+    assert res.result
+    assert len(op.evaluate_metadata_statement(res.result)) == 1
+
+    op = Operator(max_depth=3)
+    with pytest.raises(LimitExceeded):
+        op.evaluate_metadata_statement(res.result)
+
+
+def test_unpack_max_branches():
+    sms, kj = _nested_statement(1, branches=3)
+    op = Operator(max_branches=2)
+    with pytest.raises(LimitExceeded):
+        op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+
+    op = Operator(max_branches=3)
+    res = op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+    assert len(res.parsed_statement) == 3
+
+
+def test_unpack_max_verifications():
+    # 1 + 2 + 4 signed statements, but the branches are the same statement
+    # so only 1 + 1 + 1 has to be verified
+    sms, kj = _nested_statement(2, branches=2)
+    op = Operator(max_verifications=2, verified_cache_size=0)
+    with pytest.raises(LimitExceeded):
+        op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+
+    op = Operator(max_verifications=3, verified_cache_size=0,
+                  flatten_cache_size=0)
+    res = op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+    assert res.result
+    assert len(res.parsed_statement) == 2
+
+
+def test_prescan():
+    _keyjar = build_keyjar(KEYDEFS)[1]
+    fo = Operator(keyjar=_keyjar, iss=FO['swamid'])
+    unknown = Operator(keyjar=build_keyjar(KEYDEFS)[1], iss=FO['feide'])
+
+    reg = fo.pack_metadata_statement(
+        MetadataStatement(federation_usage='registration'))
+    disc = fo.pack_metadata_statement(
+        MetadataStatement(federation_usage='discovery'))
+    expired = fo.pack_metadata_statement(
+        MetadataStatement(), jwt_args={'exp': utc_time_sans_frac() - 10})
+    es = fo.pack_metadata_statement(MetadataStatement(), alg='ES256')
+    other_fo = unknown.pack_metadata_statement(MetadataStatement())
+    inter = fo.pack_metadata_statement(
+        MetadataStatement(metadata_statements={'a': reg, 'b': disc}))
+    bad_inter = fo.pack_metadata_statement(
+        MetadataStatement(metadata_statements={'a': disc}))
+
+    jb = JWKSBundle('')
+    jb[FO['swamid']] = _keyjar
+    op = Operator(jwks_bundle=jb, allowed_algs=['RS256'])
+
+    _ms = [reg, disc, expired, es, other_fo, inter, bad_inter]
+    req = MetadataStatement(metadata_statements=dict(
+        [('https://fo{}.example.org'.format(n), m) for n, m in
+         enumerate(_ms)]))
+    # no context
+    assert op.prescan(req) == {expired, es, other_fo}
+
+    skip = op.prescan(req, 'registration')
+    assert skip == {disc, expired, es, other_fo, bad_inter}
+
+    res = op.unpack_metadata_statement(json_ms=req, skip=skip)
+    assert len(res.parsed_statement) == 2
+    assert set(res.error.keys()) == {disc, expired, es, other_fo, bad_inter}
+
+
+def test_unpack_many():
+    _keyjar = build_keyjar(KEYDEFS)[1]
+    fo = Operator(keyjar=_keyjar, iss=FO['swamid'])
+    inter = fo.pack_metadata_statement(MetadataStatement(contacts=['a@b.se']))
+    sms = [fo.pack_metadata_statement(
+        MetadataStatement(client_name='client{}'.format(n),
+                          metadata_statements={FO['swamid']: inter}))
+        for n in range(5)]
+    sms.append('not.a.jws')
+
+    jb = JWKSBundle('')
+    jb[FO['swamid']] = _keyjar
+
+    for workers in [0, 2]:
+        op = Operator(jwks_bundle=jb)
+        res = list(op.unpack_many(sms, evaluate=True, workers=workers))
+        assert len(res) == 6
+        assert [pi.result['client_name'] for pi in res[:5]] == [
+            'client{}'.format(n) for n in range(5)]
+        assert [len(pi.les) for pi in res[:5]] == [1] * 5
+        assert res[5].result is None
+        assert 'not.a.jws' in res[5].error
+        # The intermediate statement is only verified once
+        assert len(op.verified) == 6
+
+
+def test_unpack_lean():
+    sms, kj = _nested_statement(2)
+    op = Operator(lean=True)
+    res = op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+    assert res.result
+    assert res.input is None
+    assert res.branch == {}
+    assert len(res.parsed_statement) == 1
+
+    _logger = logging.getLogger('fedoidc.operator')
+    _level = _logger.level
+    _logger.setLevel(logging.DEBUG)
+    try:
+        res = op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+    finally:
+        _logger.setLevel(_level)
+    assert res.input
+    assert len(res.branch) == 1
+
+    with pytest.raises(AttributeError):
+        res.extra = 1
+
+
+def test_unpack_context():
+    _keyjar = build_keyjar(KEYDEFS)[1]
+    fo = Operator(keyjar=_keyjar, iss=FO['swamid'])
+    reg = fo.pack_metadata_statement(
+        MetadataStatement(federation_usage='registration'))
+    disc = fo.pack_metadata_statement(
+        MetadataStatement(federation_usage='discovery'))
+    inter = fo.pack_metadata_statement(
+        MetadataStatement(metadata_statements={'a': disc}))
+
+    kj = KeyJar()
+    kj.import_jwks(_keyjar.export_jwks(), FO['swamid'])
+
+    req = MetadataStatement(metadata_statements={
+        FO['swamid']: reg, FO['feide']: disc, FO['edugain']: inter})
+    op = Operator()
+    res = op.unpack_metadata_statement(json_ms=req, keyjar=kj,
+                                       context='registration')
+    assert len(res.parsed_statement) == 1
+    assert set(res.result['metadata_statements'].keys()) == {FO['swamid']}
+    assert disc in res.error
+    # Neither disc nor inter has been verified
+    assert len(op.verified) == 1
+
+    # The innermost statement
+    res = op.unpack_metadata_statement(jwt_ms=disc, keyjar=kj,
+                                       context='registration')
+    assert res.result is None
+
+
+def test_unpack_keyjar_untouched():
+    _fo_kj = build_keyjar(KEYDEFS)[1]
+    _org_kj = build_keyjar(KEYDEFS)[1]
+    fo = Operator(keyjar=_fo_kj, iss=FO['swamid'])
+    org = Operator(keyjar=_org_kj, iss=OA['sunet'])
+    ms_org = fo.pack_metadata_statement(
+        MetadataStatement(signing_keys=_org_kj.export_jwks()))
+    sms = org.pack_metadata_statement(
+        MetadataStatement(contacts=['a@b.se'],
+                          metadata_statements={FO['swamid']: ms_org}))
+
+    kj = KeyJar()
+    kj.import_jwks(_fo_kj.export_jwks(), FO['swamid'])
+    op = Operator()
+    res = op.unpack_metadata_statement(jwt_ms=sms, keyjar=kj)
+    assert res.result
+    # The organisations keys were only used while unpacking
+    assert set(kj.keys()) == {FO['swamid']}
+
+    op = Operator(jwks_bundle=JWKSBundle('https://example.org'))
+    op.jwks_bundle[FO['swamid']] = kj
+    res = list(op.unpack_many([sms, sms]))
+    assert all(pi.result for pi in res)
+    assert set(op.jwks_bundle._keyjar.keys()) == {FO['swamid']}
+    # What was learned is shared by the batch
+    assert op.trusted.key_bundle(FO['swamid'], OA['sunet'])
+
+
+def test_unpack_failed_cache():
+    _fo_kj = build_keyjar(KEYDEFS)[1]
+    jb = JWKSBundle('https://example.org')
+    jb[FO['swamid']] = _fo_kj
+    # Signed with a key the receiver doesn't know about
+    fo = Operator(keyjar=build_keyjar(KEYDEFS)[1], iss=FO['swamid'])
+    sms = fo.pack_metadata_statement(MetadataStatement(contacts=['a@b.se']))
+
+    op = Operator(jwks_bundle=jb)
+    res = op.unpack_metadata_statement(jwt_ms=sms)
+    assert res.result is None
+    assert len(op.failed) == 1
+    _bad = res.error[sms]
+
+    # The same keys would be tried again, the verdict is reused
+    res = op.unpack_metadata_statement(jwt_ms=sms)
+    assert res.result is None
+    assert res.error[sms] is _bad
+
+    # Also when it appears inside another statement
+    req = MetadataStatement(metadata_statements={FO['swamid']: sms})
+    res = op.unpack_metadata_statement(json_ms=req)
+    assert res.result is None
+    assert len(op.failed) == 1
+
+    # Malformed statements are rejected without being parsed again
+    req = MetadataStatement(metadata_statements={FO['swamid']: 'foo.bar'})
+    res = op.unpack_metadata_statement(json_ms=req)
+    _err = res.error['foo.bar']
+    res = op.unpack_metadata_statement(json_ms=req)
+    assert res.error['foo.bar'] is _err
+    assert len(op.failed) == 2
+
+    # New FO keys, new chance
+    jb[FO['feide']] = build_keyjar(KEYDEFS)[1]
+    res = op.unpack_metadata_statement(jwt_ms=sms)
+    assert res.error[sms] is not _bad
+    assert len(op.failed) == 1
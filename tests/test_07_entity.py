@@ -1,9 +1,14 @@
+import json
+
 from fedoidc import MetadataStatement
+from fedoidc import ParsedJWS
 from fedoidc.bundle import JWKSBundle
 from fedoidc.entity import FederationEntity
 from fedoidc.operator import Operator
+from fedoidc.operator import chain_size
 from fedoidc.signing_service import InternalSigningService
 from fedoidc.signing_service import Signer
+from jwkest.jws import JWS
 
 from oic.oauth2 import Message
 from oic.utils.keyio import build_keyjar
@@ -47,3 +52,182 @@ def test_ace():
 
     assert 'metadata_statements' in req
     assert 'signing_keys' not in req
+
+
+def test_get_metadata_statement_priority():
+    jb = JWKSBundle('')
+    fos = ['https://example.org/', 'https://example.com/',
+           'https://example.net/']
+    for iss in fos:
+        jb[iss] = build_keyjar(KEYDEFS)[1]
+
+    req = MetadataStatement(foo='bar')
+    sms_dir = {}
+    for iss in fos:
+        op = Operator(keyjar=jb[iss], iss=iss)
+        sms_dir[iss] = op.pack_metadata_statement(MetadataStatement(),
+                                                  alg='RS256')
+    # Signed with a key that is not in the bundle
+    op = Operator(keyjar=build_keyjar(KEYDEFS)[1], iss='https://example.net/')
+    sms_dir['https://example.net/'] = op.pack_metadata_statement(
+        MetadataStatement(), alg='RS256')
+    req['metadata_statements'] = Message(**sms_dir)
+
+    ent = FederationEntity(None, fo_bundle=jb)
+    priority = ['https://example.net/', 'https://example.com/',
+                'https://example.org/']
+
+    loe = ent.get_metadata_statement(req, priority=priority)
+    assert [le.fo for le in loe] == ['https://example.com/',
+                                     'https://example.org/']
+
+    ent = FederationEntity(None, fo_bundle=jb)
+    loe = ent.get_metadata_statement(req, priority=priority,
+                                     first_valid=True)
+    assert [le.fo for le in loe] == ['https://example.com/']
+    # example.org/ has not been looked at
+    assert len(ent.verified) == 1
+
+    # Federations not on the priority list are tried last
+    ent = FederationEntity(None, fo_bundle=jb)
+    loe = ent.get_metadata_statement(req, priority=['https://example.net/'],
+                                     first_valid=True)
+    assert set([le.fo for le in loe]) == {'https://example.com/',
+                                          'https://example.org/'}
+
+
+def test_get_metadata_statement_first_valid_budget(monkeypatch):
+    jb = JWKSBundle('')
+    fos = ['https://example{}.org/'.format(n) for n in range(5)]
+    sms_dir = {}
+    for iss in fos:
+        jb[iss] = build_keyjar(KEYDEFS)[1]
+        op = Operator(keyjar=jb[iss], iss=iss)
+        _sms = op.pack_metadata_statement(MetadataStatement(), alg='RS256')
+        # Bad signature
+        _part = _sms.split('.')
+        _part[2] = _part[2][:-4] + (
+            'AAAA' if _part[2][-4:] != 'AAAA' else 'BBBB')
+        sms_dir[iss] = '.'.join(_part)
+    req = MetadataStatement(foo='bar', metadata_statements=Message(**sms_dir))
+
+    _verified = []
+    _verify = ParsedJWS.verify
+
+    def _count(self, keys):
+        _verified.append(self.jws)
+        return _verify(self, keys)
+
+    monkeypatch.setattr(ParsedJWS, 'verify', _count)
+
+    ent = FederationEntity(None, fo_bundle=jb)
+    ent.max_verifications = 3
+    loe = ent.get_metadata_statement(req, priority=fos, first_valid=True)
+    assert loe == []
+    # The limit is for the whole request
+    assert len(_verified) == 3
+
+
+def test_get_metadata_statement_parsed_once(monkeypatch):
+    jb = JWKSBundle('')
+    jb['https://example.org/'] = build_keyjar(KEYDEFS)[1]
+    fo = Operator(keyjar=jb['https://example.org/'],
+                  iss='https://example.org/')
+    org_kj = build_keyjar(KEYDEFS)[1]
+    org = Operator(keyjar=org_kj, iss='https://org.example.org/')
+    _sms = fo.pack_metadata_statement(
+        MetadataStatement(signing_keys=org_kj.export_jwks()), alg='RS256')
+    sms = org.pack_metadata_statement(
+        MetadataStatement(metadata_statements=Message(
+            **{'https://example.org/': _sms})), alg='RS256')
+    req = MetadataStatement(foo='bar', metadata_statements=Message(
+        **{'https://example.org/': sms}))
+
+    _parsed = []
+    _init = ParsedJWS.__init__
+
+    def _count(self, jws):
+        _parsed.append(jws)
+        _init(self, jws)
+
+    monkeypatch.setattr(ParsedJWS, '__init__', _count)
+
+    ent = FederationEntity(None, fo_bundle=jb)
+    loe = ent.get_metadata_statement(req, priority=['https://example.org/'],
+                                     first_valid=True)
+    assert len(loe) == 1
+    assert sorted(_parsed) == sorted([sms, _sms])
+
+
+def test_get_metadata_statement_cached():
+    jb = JWKSBundle('')
+    jb['https://example.org/'] = build_keyjar(KEYDEFS)[1]
+    op = Operator(keyjar=jb['https://example.org/'],
+                  iss='https://example.org/')
+    sms = op.pack_metadata_statement(MetadataStatement(), alg='RS256')
+    req = MetadataStatement(foo='bar', metadata_statements=Message(
+        **{'https://example.org/': sms}))
+
+    ent = FederationEntity(None, fo_bundle=jb)
+    loe = ent.get_metadata_statement(req)
+    assert len(loe) == 1
+    assert len(ent.results) == 1
+
+    ent.verified.clear()
+    ent.flattened.clear()
+    _loe = ent.get_metadata_statement(req.to_dict())
+    assert [(le.fo, le.le) for le in _loe] == [(le.fo, le.le) for le in loe]
+    assert len(ent.verified) == 0
+
+    # Modifying what was returned does not affect the cached result
+    _loe[0]['foo'] = 'xyz'
+    _loe = ent.get_metadata_statement(req)
+    assert _loe[0]['foo'] == 'bar'
+
+    # Not the same context
+    ent.get_metadata_statement(req, context='registration')
+    assert len(ent.results) == 2
+
+    # Changing the FO keys invalidates the cached results
+    jb['https://example.com/'] = build_keyjar(KEYDEFS)[1]
+    ent.get_metadata_statement(req)
+    assert len(ent.verified) == 1
+
+
+def test_get_metadata_statement_cache_memory():
+    jb = JWKSBundle('')
+    jb['https://example.org/'] = build_keyjar(KEYDEFS)[1]
+    op = Operator(keyjar=jb['https://example.org/'],
+                  iss='https://example.org/')
+    sms = op.pack_metadata_statement(MetadataStatement(foo='bar'),
+                                     alg='RS256')
+    req = MetadataStatement(metadata_statements=Message(
+        **{'https://example.org/': sms}))
+
+    ent = FederationEntity(None, fo_bundle=jb)
+    loe = ent.get_metadata_statement(req)
+    # What is counted is the size of the result not of the request
+    _size = chain_size(loe)
+    assert _size > len('"foo": "bar"')
+    assert ent.results.size == _size
+
+    # The result does not fit
+    ent = FederationEntity(None, fo_bundle=jb, result_cache_memory=_size - 1)
+    assert ent.get_metadata_statement(req)
+    assert len(ent.results) == 0
+
+
+def test_get_metadata_statement_bad_claim_types():
+    jb = JWKSBundle('')
+    jb['https://example.org/'] = build_keyjar(KEYDEFS)[1]
+    ent = FederationEntity(None, fo_bundle=jb)
+    # Signed by some key
+    _keys = build_keyjar(KEYDEFS)[1].get_signing_key('RSA')
+
+    for payload in [{'iss': 'https://example.org/', 'exp': 'x'},
+                    {'iss': ['https://example.org/']}]:
+        sms = JWS(json.dumps(payload), alg='RS256').sign_compact(_keys)
+        req = MetadataStatement(foo='bar', metadata_statements=Message(
+            **{'https://example.org/': sms}))
+        assert ent.prescan(req) == {sms}
+        assert ent.get_metadata_statement(req) == []
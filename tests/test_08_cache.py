@@ -0,0 +1,154 @@
+import json
+import time
+
+from fedoidc.cache import ExpiringCache
+from fedoidc.cache import HTTPCache
+from jwkest.jwk import SYMKey
+from jwkest.jws import JWS
+
+
+def test_set_get():
+    cache = ExpiringCache(10)
+    cache.set('foo', 'bar', time.time() + 60)
+    assert cache['foo'] == 'bar'
+    assert 'foo' in cache
+    assert cache.get('fox') is None
+
+
+def test_expired():
+    cache = ExpiringCache(10)
+    cache.set('foo', 'bar', time.time() - 1)
+    assert 'foo' not in cache
+
+    cache.set('foo', 'bar', time.time() + 1)
+    time.sleep(2)
+    assert 'foo' not in cache
+    assert len(cache) == 0
+
+
+def test_bounded():
+    cache = ExpiringCache(2)
+    _exp = time.time() + 60
+    cache.set('a', 1, _exp)
+    cache.set('b', 2, _exp)
+    assert cache['a'] == 1  # 'b' is now the least recently used
+    cache.set('c', 3, _exp)
+    assert len(cache) == 2
+    assert 'b' not in cache
+    assert set(cache.db.keys()) == {'a', 'c'}
+
+
+def test_bounded_by_size():
+    cache = ExpiringCache(10, max_size=100)
+    _exp = time.time() + 60
+    cache.set('a', 1, _exp, size=40)
+    cache.set('b', 2, _exp, size=40)
+    cache.set('c', 3, _exp, size=40)
+    assert set(cache.db.keys()) == {'b', 'c'}
+    assert cache.size == 80
+    # Too big to be cached at all
+    cache.set('d', 4, _exp, size=101)
+    assert 'd' not in cache
+    del cache['b']
+    assert cache.size == 40
+
+
+def test_disabled():
+    cache = ExpiringCache(0)
+    cache.set('foo', 'bar', time.time() + 60)
+    assert len(cache) == 0
+
+
+def make_statement(lifetime):
+    _jws = JWS(json.dumps({'iss': 'https://example.org',
+                           'exp': int(time.time()) + lifetime}), alg='HS256')
+    return _jws.sign_compact([SYMKey(key='supersecret')])
+
+
+class Response(object):
+    def __init__(self, status_code, text='', headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+
+class StubHTTPClient(object):
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def http_request(self, url, **kwargs):
+        self.requests.append((url, kwargs.get('headers')))
+        return self.responses.pop(0)
+
+
+def test_http_cache_immutable():
+    _sms = make_statement(60)
+    cli = StubHTTPClient([Response(200, _sms)])
+    cache = HTTPCache()
+    assert cache.fetch(cli, 'https://example.org/ms').text == _sms
+    assert cache.fetch(cli, 'https://example.org/ms').text == _sms
+    assert len(cli.requests) == 1
+
+
+def test_http_cache_bad_exp():
+    for exp in ['x', [1], None, True]:
+        _jws = JWS(json.dumps({'iss': 'https://example.org', 'exp': exp}),
+                   alg='HS256')
+        _sms = _jws.sign_compact([SYMKey(key='supersecret')])
+        assert HTTPCache.statement_exp(_sms) == 0
+        cli = StubHTTPClient([Response(200, _sms), Response(200, _sms)])
+        cache = HTTPCache()
+        assert cache.fetch(cli, 'https://example.org/ms').text == _sms
+        # Not cached
+        cache.fetch(cli, 'https://example.org/ms')
+        assert len(cli.requests) == 2
+
+
+def test_http_cache_no_store():
+    _sms = make_statement(60)
+    cli = StubHTTPClient([Response(200, _sms, {'cache-control': 'no-store'}),
+                          Response(200, _sms)])
+    cache = HTTPCache()
+    cache.fetch(cli, 'https://example.org/ms')
+    cache.fetch(cli, 'https://example.org/ms')
+    assert len(cli.requests) == 2
+
+
+def test_http_cache_revalidate():
+    _sms = make_statement(60)
+    cli = StubHTTPClient([
+        Response(200, _sms, {'Cache-Control': 'max-age=0', 'ETag': '"abc"'}),
+        Response(304, '', {'Cache-Control': 'max-age=30'})])
+    cache = HTTPCache()
+    cache.fetch(cli, 'https://example.org/ms')
+    rsp = cache.fetch(cli, 'https://example.org/ms')
+    assert rsp.status_code == 200
+    assert rsp.text == _sms
+    assert cli.requests[1][1] == {'If-None-Match': '"abc"'}
+    # now fresh
+    cache.fetch(cli, 'https://example.org/ms')
+    assert len(cli.requests) == 2
+
+
+def test_http_cache_capped_by_exp():
+    _sms = make_statement(1)
+    cli = StubHTTPClient([
+        Response(200, _sms, {'Cache-Control': 'max-age=3600'}),
+        Response(200, _sms)])
+    cache = HTTPCache()
+    cache.fetch(cli, 'https://example.org/ms')
+    time.sleep(2)
+    cache.fetch(cli, 'https://example.org/ms')
+    assert len(cli.requests) == 2
+
+
+def test_http_cache_negative():
+    cli = StubHTTPClient([Response(404), Response(503)])
+    cache = HTTPCache(negative_ttl=1)
+    assert cache.fetch(cli, 'https://example.org/ms').status_code == 404
+    assert cache.fetch(cli, 'https://example.org/ms').status_code == 404
+    assert len(cli.requests) == 1
+    time.sleep(2)
+    assert cache.fetch(cli, 'https://example.org/ms').status_code == 503
+    assert len(cli.requests) == 2
@@ -208,3 +208,34 @@ class TestProvider(object):
 
         clresp = json.loads(resp.message)
         assert list(clresp['metadata_statements'].keys()) == [FO['swamid']]
+
+    def test_registration_endpoint_admission(self):
+        request = ClientMetadataStatement(
+            redirect_uris=['https://example.com/rp'])
+        rp = Operator(keyjar=keybundle[FO['swamid']], iss=FO['swamid'])
+        sms = rp.pack_metadata_statement(request, alg='RS256')
+
+        _ms = dict([('{}/{}'.format(FO['swamid'], n), sms) for n in
+                    range(3)])
+        self.op.max_request_branches = 2
+        resp = self.op.registration_endpoint(
+            rp.extend_with_ms(request.copy(), _ms).to_dict())
+        assert resp.status == "400 Bad Request"
+        _err = json.loads(resp.message)
+        assert _err['error'] == 'invalid_request'
+        assert _err['error_description'] == 'Too many metadata statements'
+
+        self.op.max_jws_length = len(sms) - 1
+        resp = self.op.registration_endpoint(
+            rp.extend_with_ms(request.copy(), {FO['swamid']: sms}).to_dict())
+        assert resp.status == "400 Bad Request"
+        assert json.loads(resp.message)['error_description'] == \
+            'Signed metadata statement too large'
+
+        self.op.max_request_size = 100
+        resp = self.op.registration_endpoint(json.dumps({
+            'redirect_uris': ['https://example.com/rp'],
+            'metadata_statements': {FO['swamid']: sms}}))
+        assert resp.status == "400 Bad Request"
+        assert json.loads(resp.message)['error_description'] == \
+            'Request too large'